@@ -2,19 +2,25 @@
 Protothrottle Receiver Programmer App
 """
 
+import time
+LAUNCHED = time.perf_counter()    # startup is measured from here
+
 import toga
 import asyncio
-import time
 import itertools
 from toga.style import Pack
 from toga import Button, MultilineTextInput, Label, TextInput
 from toga.style.pack import COLUMN, ROW, CENTER, RIGHT, LEFT, START, END
 
-if toga.platform.current_platform == 'android':
-   from java import jclass
-   from android.content import Context
-else:
-   from .xbee import *
+from .linkquality import linkQualityTracker
+from .reliable import rttTable, reliableRequest
+from .nodes import nodeRegistry
+from .ptstatus import throttleTable
+from .uidispatch import uiDispatcher
+from .frames import XBEE_BD, xbeeBDParam, xbeeEscapeFrame, xbeeUnescape
+
+# platform specific modules (java on Android, pyserial on the PC) are imported
+# when the radio is brought up, not here, so the main window shows right away
 
 # Silicon Labs USB constants
 
@@ -27,6 +33,12 @@ CP210X_SET_BAUDDIV        = 0x01
 BAUD_RATE_GEN_FREQ        = 0x384000
 DEFAULT_BAUDRATE          = 38400
 DEFAULT_READ_BUFFER_SIZE  = 1024
+ACTION_USB_PERMISSION     = "com.access.device.USB_PERMISSION"
+USB_PERMISSION_TIMEOUT    = 60.0      # seconds to wait for the user to answer the permission dialog
+USB_POLL_INTERVAL         = 0.25      # how often to look for the answer
+USB_WATCH_INTERVAL        = 1.0       # how often to look for the Xbee being plugged in or pulled out
+FAST_BAUDRATE             = 115200
+MONITOR_INTERVAL          = 0.25      # seconds per read pass, the monitor stops between passes
 
 # Receiver Message types
 
@@ -76,23 +88,104 @@ ACCL = 1062
 DECL = 1063
 
 
-
-if toga.platform.current_platform == 'android':
-   # Android Java Class names, used for permissions
-   Intent = jclass('android.content.Intent')
-   PendingIntent = jclass('android.app.PendingIntent')
-
 # Main App
 class PTReceiver(toga.App):
     def startup(self):
+        self.radioReady = False
+        self.baudrate = DEFAULT_BAUDRATE
+        self.linkQuality = linkQualityTracker()
+        self.nodes = nodeRegistry()       # every node heard, by MAC, 16 bit address and node ID
+        self.nodes.subscribe(self.nodeChanged)
+        self.nodeButtons = {}
+        self.linkLabels = {}
+        self.scanMacs = []
+        self.throttles = throttleTable()  # live state of every Protothrottle broadcasting
+        self.monitoring = False
+        self.monitorTask = None           # runMonitor, awaited before anything else reads the radio
+        self.ui = uiDispatcher(self.loop)   # radio driven widget updates go through here
+        self.rtt = rttTable()             # per receiver retransmit timeouts
+        self.androidRx = bytearray()      # USB bytes not yet made into frames
+        self.device = None                # the CP210x on Android
+        self.hasPermission = False
 
         self.displayMainScreen()
+        self.windowTime = time.perf_counter() - LAUNCHED
+        print ("main window up in %.3f s" % self.windowTime)
 
-        # Use Android or PC code?
+        self.on_exit = self.exitApp
+
+        # bring the radio up in the background, Scan is enabled when it's ready
+        self.discover_button.enabled = False
+        self.monitor_button.enabled = False
+        self.fast_switch.enabled = False
+        self.working_text.text = "Connecting to Xbee..."
+        self.connecting = False
+        self.loop.create_task(self.connectRadio())
+
+        # the CP210x can come and go while we run
+        if toga.platform.current_platform == 'android':
+           self.loop.create_task(self.watchUSB())
+
+    async def connectRadio(self):
+        if self.connecting:
+           return
+        self.connecting = True
+
+        # Use Android or PC code?  Nothing here may block the UI thread
+        try:
+           if toga.platform.current_platform == 'android':
+              self.radioReady = await self.setupAndroidSerialPort()
+           else:
+              self.radioReady = await self.loop.run_in_executor(None, self.setupPCSerialPort)
+        except Exception as e:
+           print ("radio setup failed", e)
+           self.radioReady = False
+        self.connecting = False
+
+        self.radioTime = time.perf_counter() - LAUNCHED
+        print ("radio setup finished in %.3f s, ready %s" % (self.radioTime, self.radioReady))
+
+        if self.radioReady:
+           self.working_text.text = "Ready  (window %.2fs, radio %.2fs)" % (self.windowTime, self.radioTime)
+           self.discover_button.enabled = True
+           self.monitor_button.enabled = True
+           self.fast_switch.enabled = True
+        elif toga.platform.current_platform == 'android':
+           # a declined or unanswered permission dialog is asked again from Scan,
+           # watchUSB also picks up a permission given after we stopped waiting
+           self.discover_button.enabled = True
+           if self.device != None and not self.hasPermission:
+              self.working_text.text = "USB permission not given, Scan to ask again"
+           else:
+              self.working_text.text = "No Xbee found, Scan to try again"
+        else:
+           self.working_text.text = "No Xbee found"
+
+    # opt in to a faster host <-> Xbee link, falls back to 38400 if it doesn't work
+    async def changeBaudRate(self, widget):
+        if not self.radioReady or self.baudChanging:
+           return
+        want = FAST_BAUDRATE if widget.value else DEFAULT_BAUDRATE
+
+        self.baudChanging = True
+        self.working_text.text = "Changing baud rate..."
+        got = await self.loop.run_in_executor(None, self.setBaudRate, want)
+        self.working_text.text = "Xbee link %d baud" % got
+        widget.value = (got != DEFAULT_BAUDRATE)
+        self.baudChanging = False
+
+    def setBaudRate(self, baud):
         if toga.platform.current_platform == 'android':
-           self.setupAndroidSerialPort()
+           self.baudrate = self.negotiateAndroidBaud(baud)
         else:
-           self.setupPCSerialPort()
+           self.baudrate = self.Xbee.xbeeNegotiateBaud(baud)
+        return self.baudrate
+
+    # put the Xbee back to 38400 so the next start finds it
+    def exitApp(self, app, **kwargs):
+        if self.radioReady and self.baudrate != DEFAULT_BAUDRATE:
+           self.setBaudRate(DEFAULT_BAUDRATE)
+        return True
 
     def displayMainScreen(self):
         self.discover_button = Button(
@@ -101,11 +194,22 @@ class PTReceiver(toga.App):
             style=Pack(width=120, height=60, margin_top=6, background_color="#cccccc", color="#000000", font_size=12)
         )
 
+        self.monitor_button = Button(
+            'Throttles',
+            on_press=self.showMonitor,
+            style=Pack(width=120, height=60, margin_top=6, background_color="#cccccc", color="#000000", font_size=12)
+        )
+
         self.working_text = Label("", style=Pack(font_size=12, color="#000000"))
 
+        self.baudChanging = False
+        self.fast_switch = toga.Switch("High Speed Link", value=False, on_change=self.changeBaudRate, style=Pack(margin_top=6, font_size=12))
+
         scan_content = toga.Box(style=Pack(direction=COLUMN, align_items=CENTER, margin_top=5))
         scan_content.add(self.discover_button)
+        scan_content.add(self.monitor_button)
         scan_content.add(self.working_text)
+        scan_content.add(self.fast_switch)
 
         self.scroller = toga.ScrollContainer(content=scan_content, style=Pack(direction=COLUMN, align_items=CENTER))
 
@@ -113,75 +217,258 @@ class PTReceiver(toga.App):
         self.main_window.content = self.scroller
         self.main_window.show()
 
+    # swap the window content on the next UI batch, the window is already showing
+    def showScreen(self, content):
+        self.scroller = toga.ScrollContainer(content=content)
+        self.ui.call('screen', setattr, self.main_window, 'content', self.scroller)
 
-    # PC serial port
+
+    # PC serial port, returns True if an Xbee was found
+    # every Xbee dongle plugged in is used, see xbeepool.py
     def setupPCSerialPort(self):
-        self.Xbee = xbeeController()
-        if self.Xbee.getStatus() != None:
-           self.Xbee.clear()
+        from .xbeepool import xbeePool
+
+        self.Xbee = xbeePool(nodes=self.nodes)
+        if self.Xbee.getStatus() == None:
+           return False
+        self.Xbee.clear()
+        return True
+
+    # Android serial port, returns True once the port is open
+    async def setupAndroidSerialPort(self):
+        from java import jclass
 
-    # Android serial port
-    def setupAndroidSerialPort(self):
         # for now, Android
         self.context = jclass('org.beeware.android.MainActivity').singletonThis
         self.usbmanager = self.context.getSystemService(self.context.USB_SERVICE)
-        self.usbDevices = self.usbmanager.getDeviceList()
 
         # Check to see if Xbee device is connected, should only be one
-        iterator = self.usbDevices.entrySet().iterator()
-        while iterator.hasNext():
-           entry = iterator.next()
-           self.device = entry.getValue()
+        self.device = self.findUSBDevice()
+        if self.device == None:
+           print ("no USB device")
+           return False
 
         # Check USB Permissions, get them if needed
-        self.checkPermission()
-
-        # open and configure as serial port
-        self.openAndConfigureUSBPort()
+        if await self.checkPermission() == False:
+           return False
 
-        # test connection by sending a broadcast to all nodes, nothing special, not really needed
-        self.sendTestMessage()
+        # open and configure as serial port, then test connection by sending a
+        # broadcast to all nodes, nothing special, not really needed
+        def openPort():
+            self.openAndConfigureUSBPort()
+            self.sendTestMessage()
+        await self.loop.run_in_executor(None, openPort)
+        return True
+
+    def findUSBDevice(self):
+        device = None
+        iterator = self.usbmanager.getDeviceList().entrySet().iterator()
+        while iterator.hasNext():
+           entry = iterator.next()
+           device = entry.getValue()
+        return device
+
+    # hot plug, Chaquopy can't subclass BroadcastReceiver at run time so
+    # ACTION_USB_DEVICE_ATTACHED/DETACHED are picked up by watching the device list
+    async def watchUSB(self):
+        known = None                   # devices already there, startup handled those
+        while True:
+            await asyncio.sleep(USB_WATCH_INTERVAL)
+            if self.connecting or not hasattr(self, 'usbmanager'):
+               continue
+            try:
+               names = set(self.usbmanager.getDeviceList().keySet().toArray())
+            except Exception as e:
+               print ("USB device list failed", e)
+               continue
+            if known == None:
+               known = names
+            added = names - known      # only a new device gets another permission dialog
+            known = names
+
+            if self.radioReady and self.device.getDeviceName() not in names:
+               print ("Xbee unplugged")
+               self.radioReady = False      # readFrames and androidPoll stop on this
+               self.monitoring = False
+               try:
+                  self.connection.close()
+               except Exception:
+                  pass
+               self.androidRx.clear()
+               self.baudrate = DEFAULT_BAUDRATE
+               self.fast_switch.value = False
+               self.discover_button.enabled = False
+               self.monitor_button.enabled = False
+               self.fast_switch.enabled = False
+               self.working_text.text = "Xbee unplugged"
+
+            elif not self.radioReady and len(added) > 0:
+               print ("Xbee plugged in")
+               self.discover_button.enabled = False
+               self.working_text.text = "Connecting to Xbee..."
+               await self.connectRadio()
+
+            elif not self.radioReady and self.device != None and not self.hasPermission and self.device.getDeviceName() in names:
+               try:
+                  self.hasPermission = self.usbmanager.hasPermission(self.device)
+               except Exception:
+                  continue
+               if self.hasPermission:
+                  print ("USB permission given")
+                  self.discover_button.enabled = False
+                  self.working_text.text = "Connecting to Xbee..."
+                  await self.connectRadio()
 
 
     # Send network discovery, all Xbees on this network return who they are
-    def start_discover(self, widget):
+    async def start_discover(self, widget):
+        if not self.radioReady:
+           if toga.platform.current_platform == 'android' and not self.connecting:
+              # ask for the USB permission again, or find an Xbee plugged in since
+              self.discover_button.enabled = False
+              self.working_text.text = "Connecting to Xbee..."
+              self.loop.create_task(self.connectRadio())
+           else:
+              self.working_text.text = "Xbee not connected"
+           return
+
+        # the monitor's reads would take the ND responses (and on Android share
+        # the read endpoint with ours), let it finish its pass first
+        await self.stopMonitor()
+
         self.working_text.text = "Scanning for Receivers..."
+        scanStarted = time.monotonic()
 
         # broadcast - tell all Xbees to answer who they are
         self.sendNetworkDiscovery()
 
         # setup the screen buttons we will use for each receiver
         scan_content = toga.Box(style=Pack(direction=COLUMN, align_items=CENTER, margin_top=5))
-        self.buttonDict = {}
+        self.nodeButtons = {}
+        self.linkLabels = {}
+        self.scanMacs = []
 
         # read the responses, if any, sometimes several scans are required
         size, dataBuffer = self.readXbee()
         self.working_text.text = ""
 
         scan_content.add(self.discover_button)
+        scan_content.add(self.monitor_button)
         scan_content.add(self.working_text)
+        scan_content.add(self.fast_switch)
 
-        # may be several responses, turn data into list of xbee api frames
-        messages = self.parseMessageData(size, dataBuffer)
+        # may be several responses, the node registry picks them up
+        self.parseMessageData(size, dataBuffer)
 
-        # for each message, pull out the mac address and ascii node id
-        for mac in messages:
-            id  = messages[mac]
+        # a button for every node that answered this scan
+        for node in self.nodes.discoveredSince(scanStarted):
+            mac = node.mac
+            id  = node.nodeId
             print ("mac:", mac, "id:", id)
-            if mac == "" or id == "": continue
+            if id == "": continue
             fmstring = "{} {}".format(id, mac)
-            self.buttonDict[mac] = id
-            scan_content.add(
-                toga.Button(id=mac, text=fmstring,
+            self.scanMacs.append(mac)
+            self.nodeButtons[mac] = toga.Button(id=mac, text=fmstring,
                     on_press = self.connectToClient,
                     style=Pack(width=230, height=120, margin_top=12, background_color="#bbbbbb", color="#000000", font_size=16),
                 )
-            )
+            scan_content.add(self.nodeButtons[mac])
+            self.linkLabels[mac] = Label(self.linkQuality.describe(mac), style=Pack(font_size=10, color="#000000"))
+            scan_content.add(self.linkLabels[mac])
+
+        # PC only for now, the sweep needs frame level reads from the Xbee
+        if toga.platform.current_platform != 'android' and len(self.scanMacs) > 0:
+           scan_content.add(
+               toga.Button(text="Diagnostics", on_press = self.runDiagnostics,
+                   style=Pack(width=230, height=60, margin_top=24, background_color="#cccccc", color="#000000", font_size=12),
+               )
+           )
+        self.scan_content = scan_content
+        self.diag_table = None
 
-        self.scroller = toga.ScrollContainer(content=scan_content)
-        self.main_window.content = self.scroller
-        self.main_window.show()
+        self.showScreen(scan_content)
+
+    # live table of every Protothrottle broadcasting, Scan goes back to the receivers
+    def showMonitor(self, widget):
+        if not self.radioReady or self.monitoring:
+           return
+        if self.monitorTask != None and not self.monitorTask.done():
+           return                          # the last one is still stopping
 
+        scan_content = toga.Box(style=Pack(direction=COLUMN, align_items=CENTER, margin_top=5))
+        scan_content.add(self.discover_button)
+        scan_content.add(self.working_text)
+        self.monitor_table = toga.Table(headings=["Throttle", "Loco", "Speed", "Dir", "Functions", "RSSI", "Age"],
+                                        data=self.throttles.rows(), style=Pack(width=360, height=400, margin_top=12))
+        scan_content.add(self.monitor_table)
+
+        self.showScreen(scan_content)
+
+        self.monitoring = True
+        self.monitorTask = self.loop.create_task(self.runMonitor())
+
+    # frames are read off the UI thread, each throttle update asks for a redraw
+    # and the dispatcher folds them into one per UI batch
+    async def runMonitor(self):
+        while self.monitoring and self.radioReady:
+            await self.loop.run_in_executor(None, self.readFrames, MONITOR_INTERVAL)
+        self.monitoring = False
+
+    # anything else reading the radio waits for the monitor's last pass
+    async def stopMonitor(self):
+        self.monitoring = False
+        if self.monitorTask != None:
+           await self.monitorTask
+           self.monitorTask = None
+
+    def refreshMonitor(self):
+        if not self.monitoring:
+           return
+        self.monitor_table.data = self.throttles.rows()
+        self.working_text.text = "%d throttles, %d frames, %d bad" % (self.throttles.count(), self.throttles.decoded, self.throttles.crcErrors)
+
+    # everything the Xbee sends for a while, into the node registry and throttle table
+    def readFrames(self, seconds):
+        deadline = time.monotonic() + seconds
+        while self.radioReady and self.monitoring and time.monotonic() < deadline:
+            if toga.platform.current_platform == 'android':
+               p = self.androidPoll(max(0.01, deadline - time.monotonic()))
+               throttle = None
+               if p != None:
+                  self.frameSeen(p)
+                  throttle = self.throttles.update(p)
+            else:
+               msg = self.pullPacket()     # decodes throttle broadcasts as they come
+               throttle = msg[3] if msg[0] == PTBROADCAST else None
+            if throttle != None and self.monitoring:
+               self.ui.call('monitor', self.refreshMonitor)
+
+    # firmware, last hop RSSI, power and channel from every receiver found by the scan
+    async def runDiagnostics(self, widget):
+        from .remoteat import xbeeDiagnosticsSweep
+
+        widget.enabled = False
+        self.working_text.text = "Querying %d Receivers..." % len(self.scanMacs)
+        started = time.perf_counter()
+        table = await self.loop.run_in_executor(None, xbeeDiagnosticsSweep, self.Xbee, list(self.scanMacs))
+        self.working_text.text = "Diagnostics took %.1fs" % (time.perf_counter() - started)
+        widget.enabled = True
+
+        def show(v, fmt):
+            return "-" if v == None else fmt % v
+
+        rows = []
+        for mac in table:
+            d = table[mac]
+            rows.append((self.nodes.get(mac).nodeId, mac, show(d['VR'], "%04X"), show(d['DB'], "-%d dBm"), show(d['PL'], "%d"), show(d['CH'], "0x%02X")))
+
+        if self.diag_table != None:
+           self.scan_content.remove(self.diag_table)
+        self.diag_table = toga.Table(headings=["Node", "MAC", "Firmware", "RSSI", "Power", "Channel"], data=rows,
+                                     style=Pack(width=360, height=300, margin_top=12))
+        self.scan_content.add(self.diag_table)
+
+    # split a raw read into xbee api frames, on Android this is where frames reach the node registry
     def parseMessageData(self, size, data):
         messages = []
         msg = []
@@ -196,24 +483,18 @@ class PTReceiver(toga.App):
                msg.append(data[i])
         messages.append(msg)
 
-        nodeData = {}
-
-        if len(messages) <= 0: 
-           return nodeData
-
-        for msg in messages:
-            mac = ""
-            id  = ""
+        # the PC already did this in pullPacket
+        if toga.platform.current_platform == 'android':
+           for msg in messages:
+               self.frameSeen(msg)
 
-            if len(msg) > 20:
-               if msg[3] != 129:
-                  for i in range(10, 18):
-                     mac = mac + "{:02X}".format(msg[i])
-                  for i in range(19, len(msg)-2):
-                     id = id + chr(msg[i])
-                  nodeData[mac] = id
+        return messages
 
-        return nodeData
+    # a node's 16 bit address or ID changed, keep its scan button up to date
+    def nodeChanged(self, event, node):
+        btn = self.nodeButtons.get(node.mac)
+        if event == 'changed' and btn != None and node.nodeId != "":
+           self.ui.set(btn, 'text', "{} {}".format(node.nodeId, node.mac))
 
 
     # after scan, all devices are displayed as buttons, pressing one of them sends query to that mac address
@@ -237,36 +518,44 @@ class PTReceiver(toga.App):
 #        print (hexString)
 
         scan_content = toga.Box(style=Pack(direction=COLUMN, margin=30))
+        self.formFields = {}            # profile field name -> input widget
 
         MARGINTOP = 2
         LNUMWIDTH = 64
         SNUMWIDTH = 32
 
         # Ascii ID and Mac at top of display
-        idlabel  = toga.Label(self.buttonDict[buttonid.id], style=Pack(flex=1, color="#000000", align_items=CENTER, font_size=32))
+        idlabel  = toga.Label(self.nodes.get(buttonid.id).nodeId, style=Pack(flex=1, color="#000000", align_items=CENTER, font_size=32))
         maclabel = toga.Label(buttonid.id, style=Pack(flex=1, color="#000000", align_items=CENTER, font_size=12))
         boxrowA  = toga.Box(children=[idlabel], style=Pack(direction=ROW, align_items=END, margin_top=4))
         boxrowB  = toga.Box(children=[maclabel], style=Pack(direction=ROW, align_items=END, margin_top=2))
 
+        self.client_text = Label("", style=Pack(flex=1, font_size=12, color="#000000", margin_top=2))
+        boxrowC  = toga.Box(children=[self.client_text], style=Pack(direction=ROW, align_items=END))
+
         scan_content.add(boxrowA)
         scan_content.add(boxrowB)
+        scan_content.add(boxrowC)
 
         btn    = toga.Button(id=PTID, text="Prg", on_press = self.sendPrgCommand, style=Pack(width=55, height=55, margin_top=6, background_color="#bbbbbb", color="#000000", font_size=12))
         desc   = toga.Label("Protothrottle ID", style=Pack(width=275, align_items=END, font_size=18))
         entry  = toga.TextInput(on_change=self.change_ptid, style=Pack(flex=1, height=45, width=SNUMWIDTH, margin_bottom=2, font_size=18, background_color="#eeeeee", color="#000000"))
         boxrow = toga.Box(children=[desc, entry, btn], style=Pack(direction=ROW, align_items=END, margin_top=MARGINTOP))
+        self.formFields['ptid'] = entry
         scan_content.add(boxrow)
 
         btn    = toga.Button(id=BASE, text="Prg", on_press = self.sendPrgCommand, style=Pack(width=55, height=55, margin_top=6, background_color="#bbbbbb", color="#000000", font_size=12))
         desc   = toga.Label("Base ID", style=Pack(width=275, align_items=END, font_size=18))
         entry  = toga.NumberInput(on_change=self.change_ptid, style=Pack(flex=1, height=45, width=SNUMWIDTH, margin_bottom=2, font_size=18, background_color="#eeeeee", color="#000000"))
         boxrow = toga.Box(children=[desc, entry, btn], style=Pack(direction=ROW, align_items=END, margin_top=MARGINTOP))
+        self.formFields['base'] = entry
         scan_content.add(boxrow)
 
         btn    = toga.Button(id=ADDR, text="Prg", on_press = self.sendPrgCommand, style=Pack(width=55, height=55, margin_top=6, background_color="#bbbbbb", color="#000000", font_size=12))
         desc   = toga.Label("Loco Address", style=Pack(width=244, align_items=END, font_size=18))
         entry  = toga.NumberInput(on_change=self.change_ptid, min=0, max=9999, style=Pack(flex=1, height=48, width=LNUMWIDTH, margin_bottom=2, font_size=18, background_color="#eeeeee", color="#000000"))
         boxrow = toga.Box(children=[desc, entry, btn], style=Pack(direction=ROW, align_items=END, margin_top=MARGINTOP))
+        self.formFields['addr'] = entry
         scan_content.add(boxrow)
 
         btn0   = toga.Button(id=COND, text="OFF", on_press = self.sendPrgCommand, style=Pack(width=80, height=55, margin_top=6, background_color="#bbbbbb", color="#000000", font_size=14))
@@ -274,12 +563,15 @@ class PTReceiver(toga.App):
         desc   = toga.Label("Consist Address", style=Pack(width=164, align_items=END, font_size=18))
         entry  = toga.NumberInput(on_change=self.change_ptid, min=0, max=9999, style=Pack(flex=1, height=48, width=LNUMWIDTH, font_size=18, background_color="#eeeeee", color="#000000"))
         boxrow = toga.Box(children=[desc, btn0, entry, btn1], style=Pack(direction=ROW, align_items=END, margin_top=MARGINTOP))
+        self.formFields['cons'] = entry
+        self.formFields['cond'] = btn0
         scan_content.add(boxrow)
         
         btn    = toga.Button(id=DECO, text="Prg", on_press = self.sendPrgCommand, style=Pack(width=55, height=55, margin_top=10, background_color="#bbbbbb", color="#000000", font_size=12))
         desc   = toga.Label("DCC Addr", style=Pack(width=244, align_items=END, font_size=18))
         entry  = toga.NumberInput(on_change=self.change_ptid, min=0, max=9999, style=Pack(flex=1, height=48, width=LNUMWIDTH, font_size=18, background_color="#eeeeee", color="#000000"))
         boxrow = toga.Box(children=[desc, entry, btn], style=Pack(direction=ROW, align_items=END, margin_top=MARGINTOP))
+        self.formFields['deco'] = entry
         scan_content.add(boxrow)
  
        #############################################################  Servo Mode
@@ -292,6 +584,7 @@ class PTReceiver(toga.App):
         desc   = toga.Label("Servo Mode", style=Pack(width=273, align_items=END, margin_bottom=10, font_size=18))
         mode   = toga.Button(id=SRVM, text="ESC", on_press = self.sendPrgCommand, style=Pack(width=90, height=55, background_color="#bbbbbb", color="#000000", font_size=12))
         boxrow = toga.Box(children=[desc, mode], style=Pack(direction=ROW, align_items=END, margin_top=20))
+        self.formFields['srvm'] = mode
         scan_content.add(boxrow)
 
        ############################################################# 
@@ -304,18 +597,21 @@ class PTReceiver(toga.App):
         desc   = toga.Label("Servo 0", style=Pack(width=270, align_items=END, font_size=18))
         rev    = toga.Switch("Reverse", id=SVR0, value=False, on_change=self.change_ptid)
         boxrow = toga.Box(children=[desc, rev], style=Pack(direction=ROW, align_items=END, margin_top=8))
+        self.formFields['svr0'] = rev
         scan_content.add(boxrow)
 
         btn    = toga.Button(id=SRVP0, text="Prg", on_press = self.sendPrgCommand, style=Pack(width=55, height=55, margin_top=6, background_color="#bbbbbb", color="#000000", font_size=12))
         desc   = toga.Label("     Function Code", style=Pack(width=282, align_items=END, font_size=12))
         func   = toga.NumberInput(on_change=self.change_ptid, min=0, max=99, style=Pack(flex=1, height=48, width=24, font_size=12, background_color="#eeeeee", color="#000000"))
         boxrow = toga.Box(children=[desc, func, btn], style=Pack(direction=ROW, align_items=END, margin_top=1))
+        self.formFields['srvp0'] = func
         scan_content.add(boxrow)
 
         desc   = toga.Label("     Low Limit", style=Pack(width=244, align_items=END, font_size=12))
         entry0 = toga.NumberInput(on_change=self.change_ptid, min=0, max=1000, style=Pack(flex=1, height=48, width=LNUMWIDTH, font_size=18, background_color="#eeeeee", color="#000000"))
         btn    = toga.Button(id=SV0L, text="Prg", on_press = self.sendPrgCommand, style=Pack(width=55, height=55, margin_top=6, background_color="#bbbbbb", color="#000000", font_size=12))
         boxrow = toga.Box(children=[desc, entry0, btn], style=Pack(direction=ROW, align_items=END, margin_top=1))
+        self.formFields['sv0l'] = entry0
         scan_content.add(boxrow)
 
         desc   = toga.Label(" ", style=Pack(width=20, align_items=END, font_size=18))
@@ -327,6 +623,7 @@ class PTReceiver(toga.App):
         desc   = toga.Label("     High Limit", style=Pack(width=244, align_items=END, font_size=12))
         entry1  = toga.NumberInput(on_change=self.change_ptid, min=0, max=9999, style=Pack(flex=1, height=48, width=LNUMWIDTH, font_size=18, background_color="#eeeeee", color="#000000"))
         boxrow = toga.Box(children=[desc, entry1, btn], style=Pack(direction=ROW, align_items=END, margin_top=1))
+        self.formFields['sv0h'] = entry1
         scan_content.add(boxrow)
 
         desc   = toga.Label(" ", style=Pack(width=20, align_items=END, font_size=18))
@@ -345,18 +642,21 @@ class PTReceiver(toga.App):
         desc   = toga.Label("Servo 1", style=Pack(width=270, align_items=END, font_size=18))
         rev    = toga.Switch("Reverse", id=SVR1, value=False, on_change=self.change_ptid)
         boxrow = toga.Box(children=[desc, rev], style=Pack(direction=ROW, align_items=END, margin_top=8))
+        self.formFields['svr1'] = rev
         scan_content.add(boxrow)
 
         btn    = toga.Button(id=SRVP1, text="Prg", on_press = self.sendPrgCommand, style=Pack(width=55, height=55, margin_top=6, background_color="#bbbbbb", color="#000000", font_size=12))
         desc   = toga.Label("     Function Code", style=Pack(width=282, align_items=END, font_size=12))
         func   = toga.NumberInput(on_change=self.change_ptid, min=0, max=99, style=Pack(flex=1, height=48, width=24, font_size=12, background_color="#eeeeee", color="#000000"))
         boxrow = toga.Box(children=[desc, func, btn], style=Pack(direction=ROW, align_items=END, margin_top=1))
+        self.formFields['srvp1'] = func
         scan_content.add(boxrow)
 
         desc   = toga.Label("     Low Limit", style=Pack(width=244, align_items=END, font_size=12))
         entry0 = toga.NumberInput(on_change=self.change_ptid, min=0, max=1000, style=Pack(flex=1, height=48, width=LNUMWIDTH, font_size=18, background_color="#eeeeee", color="#000000"))
         btn    = toga.Button(id=SV1L, text="Prg", on_press = self.sendPrgCommand, style=Pack(width=55, height=55, margin_top=6, background_color="#bbbbbb", color="#000000", font_size=12))
         boxrow = toga.Box(children=[desc, entry0, btn], style=Pack(direction=ROW, align_items=END, margin_top=1))
+        self.formFields['sv1l'] = entry0
         scan_content.add(boxrow)
 
         desc   = toga.Label(" ", style=Pack(width=20, align_items=END, font_size=18))
@@ -368,6 +668,7 @@ class PTReceiver(toga.App):
         desc   = toga.Label("     High Limit", style=Pack(width=244, align_items=END, font_size=12))
         entry1  = toga.NumberInput(on_change=self.change_ptid, min=0, max=9999, style=Pack(flex=1, height=48, width=LNUMWIDTH, font_size=18, background_color="#eeeeee", color="#000000"))
         boxrow = toga.Box(children=[desc, entry1, btn], style=Pack(direction=ROW, align_items=END, margin_top=1))
+        self.formFields['sv1h'] = entry1
         scan_content.add(boxrow)
 
         desc   = toga.Label(" ", style=Pack(width=20, align_items=END, font_size=18))
@@ -385,18 +686,21 @@ class PTReceiver(toga.App):
         desc   = toga.Label("Servo 2", style=Pack(width=270, align_items=END, font_size=18))
         rev    = toga.Switch("Reverse", id=SVR2, value=False, on_change=self.change_ptid)
         boxrow = toga.Box(children=[desc, rev], style=Pack(direction=ROW, align_items=END, margin_top=8))
+        self.formFields['svr2'] = rev
         scan_content.add(boxrow)
 
         btn    = toga.Button(id=SRVP2, text="Prg", on_press = self.sendPrgCommand, style=Pack(width=55, height=55, margin_top=6, background_color="#bbbbbb", color="#000000", font_size=12))
         desc   = toga.Label("     Function Code", style=Pack(width=282, align_items=END, font_size=12))
         func   = toga.NumberInput(on_change=self.change_ptid, min=0, max=99, style=Pack(flex=1, height=48, width=24, font_size=12, background_color="#eeeeee", color="#000000"))
         boxrow = toga.Box(children=[desc, func, btn], style=Pack(direction=ROW, align_items=END, margin_top=1))
+        self.formFields['srvp2'] = func
         scan_content.add(boxrow)
 
         desc   = toga.Label("     Low Limit", style=Pack(width=244, align_items=END, font_size=12))
         entry0 = toga.NumberInput(on_change=self.change_ptid, min=0, max=1000, style=Pack(flex=1, height=48, width=LNUMWIDTH, font_size=18, background_color="#eeeeee", color="#000000"))
         btn    = toga.Button(id=SV2L, text="Prg", on_press = self.sendPrgCommand, style=Pack(width=55, height=55, margin_top=6, background_color="#bbbbbb", color="#000000", font_size=12))
         boxrow = toga.Box(children=[desc, entry0, btn], style=Pack(direction=ROW, align_items=END, margin_top=1))
+        self.formFields['sv2l'] = entry0
         scan_content.add(boxrow)
 
         desc   = toga.Label(" ", style=Pack(width=20, align_items=END, font_size=18))
@@ -408,6 +712,7 @@ class PTReceiver(toga.App):
         desc   = toga.Label("     High Limit", style=Pack(width=244, align_items=END, font_size=12))
         entry1  = toga.NumberInput(on_change=self.change_ptid, min=0, max=9999, style=Pack(flex=1, height=48, width=LNUMWIDTH, font_size=18, background_color="#eeeeee", color="#000000"))
         boxrow = toga.Box(children=[desc, entry1, btn], style=Pack(direction=ROW, align_items=END, margin_top=1))
+        self.formFields['sv2h'] = entry1
         scan_content.add(boxrow)
 
         desc   = toga.Label(" ", style=Pack(width=20, align_items=END, font_size=18))
@@ -424,14 +729,217 @@ class PTReceiver(toga.App):
         desc   = toga.Label("Watch Dog", style=Pack(width=282, align_items=END, font_size=12))
         func   = toga.NumberInput(on_change=self.change_ptid, min=0, max=99, style=Pack(flex=1, height=48, width=24, font_size=12, background_color="#eeeeee", color="#000000"))
         boxrow = toga.Box(children=[desc, func, btn], style=Pack(direction=ROW, align_items=END, margin_top=1))
+        self.formFields['wdog'] = func
         scan_content.add(boxrow)
 
+       ############################################################# Profiles, PC only for now
 
+        if toga.platform.current_platform != 'android':
+           from .profiles import profileStore
 
+           self.clientMac = buttonid.id
+           self.profiles = profileStore()
+           current, fields = self.profiles.forMac(self.clientMac)
 
-        self.scroller = toga.ScrollContainer(content=scan_content)
-        self.main_window.content = self.scroller
-        self.main_window.show()
+           boxrow = toga.Box(children=[blank, toga.Divider(), blank], style=Pack(direction=COLUMN, margin_top=20))
+           scan_content.add(boxrow)
+
+           btn    = toga.Button(text="Save", on_press = self.saveProfile, style=Pack(width=80, height=55, margin_top=6, background_color="#bbbbbb", color="#000000", font_size=12))
+           self.profile_name = toga.TextInput(value=current or "", placeholder="Profile Name", style=Pack(flex=1, height=45, font_size=18, background_color="#eeeeee", color="#000000"))
+           boxrow = toga.Box(children=[self.profile_name, btn], style=Pack(direction=ROW, align_items=END, margin_top=MARGINTOP))
+           scan_content.add(boxrow)
+
+           btn    = toga.Button(text="Load", on_press = self.loadProfile, style=Pack(width=80, height=55, margin_top=6, background_color="#bbbbbb", color="#000000", font_size=12))
+           self.profile_select = toga.Selection(items=self.profiles.names(), style=Pack(flex=1, height=45, font_size=18))
+           if current in self.profiles.names():
+              self.profile_select.value = current
+           boxrow = toga.Box(children=[self.profile_select, btn], style=Pack(direction=ROW, align_items=END, margin_top=MARGINTOP))
+           scan_content.add(boxrow)
+
+           # Capture reads this receiver's EEPROM into the named profile, Apply writes the
+           # selected profile's EEPROM to this receiver with the overrides laid over it
+           btn0   = toga.Button(text="Capture", on_press = self.captureProfile, style=Pack(width=80, height=55, margin_top=6, background_color="#bbbbbb", color="#000000", font_size=12))
+           btn1   = toga.Button(text="Apply", on_press = self.applyProfile, style=Pack(width=80, height=55, margin_top=6, background_color="#bbbbbb", color="#000000", font_size=12))
+           self.profile_overrides = toga.TextInput(placeholder="ADDR=HEX,ADDR=HEX", style=Pack(flex=1, height=45, font_size=18, background_color="#eeeeee", color="#000000"))
+           boxrow = toga.Box(children=[self.profile_overrides, btn0, btn1], style=Pack(direction=ROW, align_items=END, margin_top=MARGINTOP))
+           scan_content.add(boxrow)
+
+           self.profile_text = Label("", style=Pack(font_size=12, color="#000000", margin_top=4))
+           scan_content.add(self.profile_text)
+
+           if fields != None:
+              self.loadForm(fields)
+
+        self.showScreen(scan_content)
+
+        self.loop.create_task(self.queryClient(buttonid.id, data, messageFrame))
+
+    # send the RETURNTYPE query until the receiver answers, on its own adaptive timeout
+    async def queryClient(self, mac, data, messageFrame):
+        self.client_text.text = "Asking receiver..."
+        answer = self.clientAnswer(mac)
+
+        if toga.platform.current_platform == 'android':
+           send = lambda: self.connection.bulkTransfer(self.writeEndpoint, bytearray(messageFrame), len(messageFrame), USB_WRITE_TIMEOUT_MILLIS)
+           reply = await self.loop.run_in_executor(None, reliableRequest, send, self.androidPoll, answer, self.rtt, mac)
+        else:
+           from .txpipeline import xbeeReliableRequest
+           reply = await self.loop.run_in_executor(None, xbeeReliableRequest, self.Xbee, mac, data, lambda p: answer(p) == True, self.rtt)
+
+        srtt = self.rtt.get(mac).srtt
+        if reply != None:
+           self.frameSeen(reply)
+           self.client_text.text = "Receiver answered" if srtt == None else "Receiver answered, round trip %d ms" % round(srtt * 1000)
+        else:
+           self.client_text.text = "No answer from receiver"
+        print ("rtt", mac, self.rtt.summary(mac))
+
+    # what a frame means to a request sent to mac, see reliableRequest
+    def clientAnswer(self, mac):
+        def match(p):
+            if len(p) < 8:
+               return None
+            if p[3] == 137 and p[4] == 0x01 and p[5] != 0:    # our transmit failed, send again
+               return False
+            if p[3] == 128 and len(p) > 14 and (p[13] & 0x02) == 0:
+               src = ""
+               for i in range(4, 12):
+                  src = src + "{:02X}".format(p[i])
+               return True if src == mac else None
+            if p[3] == 129 and (p[7] & 0x02) == 0:             # directed, not a broadcast
+               node = self.nodes.find16((p[4] << 8) | p[5])
+               return True if node != None and node.mac == mac else None
+            return None
+        return match
+
+    # one API frame from the USB port, None if no whole frame came in time
+    def androidPoll(self, timeout):
+        buf = bytearray(DEFAULT_READ_BUFFER_SIZE)
+        deadline = time.monotonic() + timeout
+        while True:
+            i = self.androidRx.find(0x7e)
+            if i < 0:
+               self.androidRx.clear()
+            elif len(self.androidRx) >= i + 3:
+               end = i + 4 + ((self.androidRx[i+1] << 8) | self.androidRx[i+2])
+               if len(self.androidRx) >= end:
+                  frame = list(self.androidRx[i:end])
+                  del self.androidRx[:end]
+                  return frame
+
+            wait = int((deadline - time.monotonic()) * 1000)
+            if wait <= 0:
+               return None
+            if not self.radioReady:      # unplugged, the connection is closed
+               time.sleep(wait / 1000)
+               return None
+            n = self.connection.bulkTransfer(self.readEndpoint, buf, DEFAULT_READ_BUFFER_SIZE, wait)
+            if n > 0:
+               self.androidRx.extend(buf[:n])
+
+    # receiver screen <-> profile fields
+    def formValues(self):
+        fields = {}
+        for name in self.formFields:
+            w = self.formFields[name]
+            if isinstance(w, toga.Switch):
+               fields[name] = int(w.value)
+            elif isinstance(w, toga.NumberInput):
+               if w.value != None:
+                  fields[name] = int(w.value)
+            elif isinstance(w, toga.Button):
+               fields[name] = w.text
+            elif w.value.strip() != "":
+               fields[name] = w.value.strip()
+        return fields
+
+    def loadForm(self, fields):
+        for name in fields:
+            w = self.formFields.get(name)
+            if w == None:
+               continue
+            if isinstance(w, toga.Switch):
+               w.value = bool(fields[name])
+            elif isinstance(w, toga.Button):
+               w.text = fields[name]
+            else:
+               w.value = fields[name]
+
+    def saveProfile(self, widget):
+        name = self.profile_name.value.strip()
+        if name == "":
+           self.profile_text.text = "Profile needs a name"
+           return
+        try:
+           self.profiles.save(name, self.formValues(), self.clientMac)
+        except ValueError as e:
+           self.profile_text.text = str(e)
+           return
+        self.profile_select.items = self.profiles.names()
+        self.profile_select.value = name
+        self.profile_text.text = "Saved %s" % name
+
+    # fill the screen from the chosen profile, keeping the loco address already
+    # on it.  Only the screen changes, Apply is what writes the receiver
+    def loadProfile(self, widget):
+        name = self.profile_select.value
+        fields = self.profiles.get(name)
+        if fields == None:
+           return
+        fields = dict(fields)
+        if self.formFields['addr'].value != None:
+           fields.pop('addr', None)
+        self.loadForm(fields)
+        self.profile_text.text = "Loaded %s" % name
+
+    # read this receiver's EEPROM as the named profile's image
+    async def captureProfile(self, widget):
+        from .eeprom import eepromReadImage
+        from .profiles import PROFILE_START, PROFILE_SIZE
+
+        name = self.profile_name.value.strip()
+        if name == "":
+           self.profile_text.text = "Profile needs a name"
+           return
+        await self.stopMonitor()
+        self.profile_text.text = "Reading receiver..."
+        image, missing = await self.loop.run_in_executor(None, lambda: eepromReadImage(self.Xbee, self.clientMac, PROFILE_START, PROFILE_SIZE, nodes=self.nodes))
+        if len(missing) > 0:
+           self.profile_text.text = "No answer reading %d bytes, nothing saved" % len(missing)
+           return
+        self.profiles.saveImage(name, PROFILE_START, image, self.clientMac)
+        self.profile_select.items = self.profiles.names()
+        self.profile_select.value = name
+        self.profile_text.text = "Captured %s, %d bytes CRC %s" % (name, len(image), self.profiles.imageSummary(name)['crc'])
+
+    # write the selected profile's image to this receiver, read back and fix what differs
+    async def applyProfile(self, widget):
+        from .profiles import parseOverrides, applyProfileImage
+
+        name = self.profile_select.value
+        saved = self.profiles.image(name) if name != None else None
+        if saved == None:
+           self.profile_text.text = "Profile has no EEPROM image, Capture one first"
+           return
+        try:
+           overrides = {self.clientMac: parseOverrides(self.profile_overrides.value)}
+        except ValueError as e:
+           self.profile_text.text = str(e)
+           return
+        start, image = saved
+        await self.stopMonitor()
+        self.profile_text.text = "Writing %s..." % name
+        try:
+           result = await self.loop.run_in_executor(None, lambda: applyProfileImage(self.Xbee, [self.clientMac], start, image, overrides, self.nodes))
+        except ValueError as e:               # an override outside the image
+           self.profile_text.text = str(e)
+           return
+        report = list(result['nodes'].values())[0]
+        if report['ok']:
+           self.profiles.remember([self.clientMac], name)
+           self.profile_text.text = "Applied %s, %d bytes CRC %s" % (name, report['size'], report['crc'])
+        else:
+           self.profile_text.text = "Apply failed, %d ranges differ, %d not read" % (len(report['bad']), len(report['missing']))
 
     def change_ptid(self, id):
         pass
@@ -444,17 +952,7 @@ class PTReceiver(toga.App):
 
 
     def buildAddress(self, adr):
-        address = adr.id
-        dest    = [0,0,0,0,0,0,0,0]
-        dest[0] = int(address[:2], 16)           # very brute force way to pull this out!
-        dest[1] = int(address[2:4], 16)
-        dest[2] = int(address[4:6], 16)
-        dest[3] = int(address[6:8], 16)
-        dest[4] = int(address[8:10], 16)
-        dest[5] = int(address[10:12], 16)
-        dest[6] = int(address[12:14], 16)
-        dest[7] = int(address[14:16], 16)
-        return dest
+        return self.nodes.get(adr.id).address   # 8 byte mac, worked out when the node was first heard
 
     # read any data from the Xbee
     def readXbee(self):
@@ -467,6 +965,7 @@ class PTReceiver(toga.App):
                USB_READ_TIMEOUT_MILLIS,
            )
         else:
+           buf = []
            while(1):
                nodedata = self.pullPacket()
                print ('nodedata from scan', nodedata)
@@ -474,12 +973,12 @@ class PTReceiver(toga.App):
 
                if msgtype == DISCOVERYRESPONSE:
                   print ("DISCOVERY RESPONSE")
+                  buf.extend(nodedata[3])        # raw frames, same as Android's buffer
 
                if msgtype == None:
                   break
 
-           totalBytesRead = len(nodedata)
-           buf = nodedata
+           totalBytesRead = len(buf)
 
         return totalBytesRead, buf
 
@@ -530,36 +1029,113 @@ class PTReceiver(toga.App):
                  USB_WRITE_TIMEOUT_MILLIS,
                  )
 
+        self.setUSBBaudRate(DEFAULT_BAUDRATE)
+
+    # CP210x baud rate is set as a divider of its baud rate generator
+    def setUSBBaudRate(self, baud):
+        buf = None
+
         result = self.connection.controlTransfer(
                  REQTYPE_HOST_TO_INTERFACE,
                  CP210X_SET_BAUDDIV,
-                 int(BAUD_RATE_GEN_FREQ / DEFAULT_BAUDRATE),
+                 int(BAUD_RATE_GEN_FREQ / baud),
                  0,
                  buf,
                  (0 if buf is None else len(buf)),
                  USB_WRITE_TIMEOUT_MILLIS,
                  )
+        self.baudrate = baud
+        return result
+
+    # send an AT command to our Xbee, True if it answers OK
+    def androidATCommand(self, cmdh, cmdl, data=[], timeout=0.6):
+        frame = xbeeEscapeFrame(self.buildXbeeATCommand(cmdh, cmdl, data))   # AP=2, same as the PC
+        buf = bytearray(DEFAULT_READ_BUFFER_SIZE)
+        self.connection.bulkTransfer(self.readEndpoint, buf, DEFAULT_READ_BUFFER_SIZE, 10)   # flush
+        self.connection.bulkTransfer(self.writeEndpoint, bytearray(frame), len(frame), USB_WRITE_TIMEOUT_MILLIS)
+
+        rx = bytearray()
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            n = self.connection.bulkTransfer(self.readEndpoint, buf, DEFAULT_READ_BUFFER_SIZE, 100)
+            if n > 0:
+               rx = rx + buf[:n]
+            for raw in rx.split(b'\x7e')[1:]:    # an unescaped 0x7E only ever starts a frame
+                f = xbeeUnescape(raw)               # len len 88 fid cmd cmd status
+                if len(f) >= 7 and f[2] == 0x88 and f[4] == ord(cmdh) and f[5] == ord(cmdl):
+                   return f[6] == 0
+        return False
+
+    # same as xbeeNegotiateBaud on the PC, ATBD then switch the CP210x to match
+    def negotiateAndroidBaud(self, baud):
+        old = self.baudrate
+        if baud == old or baud not in XBEE_BD:
+           return old
+
+        if not self.androidATCommand('B', 'D', list(xbeeBDParam(baud))):
+           print ("Xbee refused baud rate", baud)
+           return old
+
+        self.setUSBBaudRate(baud)
+        time.sleep(0.05)
+        if self.androidATCommand('V', 'R'):
+           return baud
+
+        print ("no answer at", baud, "falling back to", old)
+        self.setUSBBaudRate(old)
+        if self.androidATCommand('V', 'R'):
+           return old
+
+        self.setUSBBaudRate(baud)       # it did switch but the link is bad, ask it to go back
+        self.androidATCommand('B', 'D', list(xbeeBDParam(old)))
+        self.setUSBBaudRate(old)
+        time.sleep(0.05)
+        self.androidATCommand('V', 'R')
+        return old
 
 
     # check for permission from the user and wait if required
-    def checkPermission(self):
-        ACTION_USB_PERMISSION = "com.access.device.USB_PERMISSION"
+    # the wait sleeps on the app's loop, the UI keeps running while the dialog
+    # is up, and a user who declines (or never answers) gets False after a while
+    async def checkPermission(self):
+        from java import jclass
+        Intent = jclass('android.content.Intent')
+        PendingIntent = jclass('android.app.PendingIntent')
+
+        try:
+           self.hasPermission = self.usbmanager.hasPermission(self.device)
+        except:
+           print ("no USB device")
+           return False
+        if self.hasPermission:
+           return True
+
         intent = Intent(ACTION_USB_PERMISSION)
         try:
            pintent = PendingIntent.getBroadcast(self.context, 0, intent, 0)
         except Exception:
            pintent = PendingIntent.getBroadcast(self.context, 0, intent, PendingIntent.FLAG_IMMUTABLE)
-        
+
         try:
            self.usbmanager.requestPermission(self.device, pintent)
-           self.hasPermission = self.usbmanager.hasPermission(self.device)
         except:
            print ("no USB device")
            return False
 
+        self.working_text.text = "Waiting for USB permission..."
+        deadline = time.monotonic() + USB_PERMISSION_TIMEOUT
         while not self.hasPermission:
-            self.hasPermission = self.usbmanager.hasPermission(self.device)
-            
+            if time.monotonic() > deadline:
+               print ("no USB permission")
+               self.working_text.text = "USB permission not given"
+               return False
+            await asyncio.sleep(USB_POLL_INTERVAL)
+            try:
+               self.hasPermission = self.usbmanager.hasPermission(self.device)
+            except:
+               return False          # unplugged while we waited
+        return True
+
 ##
 ## Send Directed Message to an Xbee on the Network
 ##
@@ -604,6 +1180,22 @@ class PTReceiver(toga.App):
 
         return frame
 
+##
+## AT Command to our own Xbee, with optional parameter bytes
+##
+
+    def buildXbeeATCommand(self, cmdh, cmdl, data=[]):
+        frame = [0x7e, 0, 4 + len(data), 0x08, 0x01, ord(cmdh), ord(cmdl)]
+        for d in data:
+            frame.append(d & 0xFF)
+
+        cks = 0
+        for i in range(3, len(frame)):   # compute checksum
+            cks += frame[i]
+        frame.append((255-cks) & 0x00ff)
+
+        return frame
+
 #
 # Read from Xbee if we are on PC
 
@@ -625,10 +1217,13 @@ class PTReceiver(toga.App):
            msb     = data[1]
            lsb     = data[2]
 
+           self.frameSeen(data)
+
            if msgtype == 129:
               if data[7] == 2:
                  #print ("Protothrottle Broadcast")
-                 return [PTBROADCAST, None, None, None]
+                 throttle = self.throttles.update(data)
+                 return [PTBROADCAST, None, None, throttle]
 
               if data[7] == 0:
                  # process a return directed message from my receiver
@@ -641,7 +1236,7 @@ class PTReceiver(toga.App):
               if lsb > 5:                        # is this from external nodes?
                  nodeid  = self.getNodeID(data)       # yep, grab some stuff
                  address = self.getAddress(data)      # Node ID and network address
-                 return [DISCOVERYRESPONSE, address, nodeid, None]
+                 return [DISCOVERYRESPONSE, address, nodeid, data]
               else:
                  #print ("internal ND response")  # otherwise it's from us, just toss it
                  return [INTERNALRESPONSE, None, None, None]
@@ -655,6 +1250,35 @@ class PTReceiver(toga.App):
         return [None, None, None, None]
 
 
+    # RSSI from every frame that carries one, keyed by MAC when we know it
+
+    def trackLinkQuality(self, data, node):
+        if len(data) < 8:
+           return
+        msgtype = data[3]
+
+        if msgtype == 129:                       # receive 16 bit, RSSI after the address
+           src = (data[4] << 8) | data[5]
+           self.linkQuality.update(src if node == None else node.mac, data[6])
+
+        elif msgtype == 128 and node != None:    # receive 64 bit
+           self.linkQuality.update(node.mac, data[12])
+
+        elif msgtype == 136 and node != None:    # ND response, DB
+           self.linkQuality.update(node.mac, data[18])
+
+    # every frame read from the Xbee comes through here
+    def frameSeen(self, data):
+        node = self.nodes.update(data)
+        self.trackLinkQuality(data, node)
+        if node != None and node.mac in self.linkLabels:
+           self.ui.call(('link', node.mac), self.refreshLinkLabel, node.mac)
+
+    def refreshLinkLabel(self, mac):
+        label = self.linkLabels.get(mac)
+        if label != None:
+           label.text = self.linkQuality.describe(mac)
+
     # get ascii mac address
 
     def getAddress(self, data):
@@ -0,0 +1,166 @@
+
+# Offline decode of raw Xbee serial captures
+#
+# The batch counterpart of getPacket / parseMessageData for post session
+# analysis of multi megabyte byte logs.  The log is memory mapped and every
+# step - unescape, finding 0x7E frame starts, Xbee checksums, MRBus CRCs and
+# pulling out the header fields - is done as numpy passes over all frames at
+# once rather than a byte at a time.
+#
+#    frames, data = decodeCapture('session.bin')
+#    frames[frames['type'] == 0x81]['rssi']
+#
+# numpy is only needed here, the app and the command line tool don't load it.
+
+try:
+   import numpy as np
+except ImportError:
+   np = None
+
+from .frames import MRBUS_CRC_TABLE
+
+CAPTURE_BAUDRATE = 38400
+
+FRAME_DTYPE = [
+    ('offset',   'i8'),     # byte offset of the 0x7E in the raw log
+    ('offset_s', 'f8'),     # estimated seconds into the log: offset * 10 bits / line baud, assumes the
+                            # line never went idle, so it's a lower bound and not a timestamp
+    ('type',     'u1'),     # Xbee API frame type
+    ('source',   'u8'),     # 16 or 64 bit source address of receive frames, else 0
+    ('rssi',     'u1'),     # -dBm of receive frames, else 0
+    ('payload',  'i8'),     # offset of the payload (MRBus packet for receive frames) in the unescaped data
+    ('length',   'u2'),     # payload length
+    ('mrbus_ok', '?'),      # receive frame carrying an MRBus packet with a good CRC
+]
+
+def needNumpy():
+   if np == None:
+      raise ImportError("capture decoding needs numpy, pip install numpy")
+
+##
+## Unescape (API mode 2), returns the data and the raw offset of each byte
+##
+
+def unescapeCapture(raw):
+   esc = raw == 0x7D
+   data = raw.copy()
+   data[1:][esc[:-1]] ^= 0x20             ## byte after an escape is XOR 0x20
+   keep = ~esc
+   return data[keep], np.nonzero(keep)[0]
+
+##
+## MRBus CRC16 of many packets at once, mrbusCRC16 with one packet per lane
+## starts are offsets of each packet in data, lengths their MRBus length byte
+##
+
+def mrbusCRC16Many(data, starts, lengths):
+   table = np.array(MRBUS_CRC_TABLE, dtype=np.uint16)
+   crc = np.zeros(len(starts), dtype=np.uint16)
+
+   for j in range(int(lengths.max()) if len(lengths) else 0):
+      if j == 3 or j == 4:                ## the CRC bytes themselves
+         continue
+      live = j < lengths
+      a = data[np.where(live, starts + j, 0)]
+      nc = (crc << np.uint16(8)) ^ table[(crc >> np.uint16(8)) ^ a]
+      crc = np.where(live, nc, crc).astype(np.uint16)
+
+   return crc
+
+##
+## Decode a capture file, returns (frames, data)
+## frames is a structured array of FRAME_DTYPE, payload offsets index data
+##
+
+def decodeCapture(path, escaped=True, baud=CAPTURE_BAUDRATE):
+   needNumpy()
+   raw = np.memmap(path, dtype=np.uint8, mode='r')
+   return decodeBytes(np.asarray(raw), escaped, baud)
+
+def decodeBytes(raw, escaped=True, baud=CAPTURE_BAUDRATE):
+   needNumpy()
+   raw = np.asarray(raw, dtype=np.uint8)
+   if escaped:
+      data, rawOffset = unescapeCapture(raw)
+   else:
+      data, rawOffset = raw, np.arange(len(raw))
+   n = len(data)
+
+   # candidate starts, length, checksum over type..checksum must be 0xFF
+   s = np.nonzero(data == 0x7E)[0]
+   s = s[s + 4 < n]
+   length = (data[s + 1].astype(np.int64) << 8) | data[s + 2]
+   end = s + 3 + length                   ## index of the checksum byte
+   ok = (length > 0) & (end < n)
+   s, length, end = s[ok], length[ok], end[ok]
+
+   csum = np.concatenate(([0], np.cumsum(data, dtype=np.int64)))
+   ok = ((csum[end + 1] - csum[s + 3]) & 0xFF) == 0xFF
+   s, length, end = s[ok], length[ok], end[ok]
+
+   if not escaped:
+      s, length, end = dropOverlaps(s, length, end)
+
+   frames = np.zeros(len(s), dtype=FRAME_DTYPE)
+   ftype = data[s + 3]
+   frames['offset']  = rawOffset[s]
+   frames['offset_s'] = frames['offset'] * 10.0 / baud
+   frames['type']    = ftype
+   frames['payload'] = s + 4
+   frames['length']  = length - 1
+
+   # receive 16 bit: 81 src src rssi opt payload
+   rx16 = (ftype == 0x81) & (length >= 5)
+   i = s[rx16]
+   frames['source'][rx16]  = (data[i + 4].astype(np.uint64) << 8) | data[i + 5]
+   frames['rssi'][rx16]    = data[i + 6]
+   frames['payload'][rx16] = i + 8
+   frames['length'][rx16]  = length[rx16] - 5
+
+   # receive 64 bit: 80 src*8 rssi opt payload
+   rx64 = (ftype == 0x80) & (length >= 11)
+   i = s[rx64]
+   src = np.zeros(len(i), dtype=np.uint64)
+   for k in range(8):
+      src = (src << np.uint64(8)) | data[i + 4 + k]
+   frames['source'][rx64]  = src
+   frames['rssi'][rx64]    = data[i + 12]
+   frames['payload'][rx64] = i + 14
+   frames['length'][rx64]  = length[rx64] - 11
+
+   # MRBus packets in receive frames, length byte must fit what we received
+   rx = np.nonzero((rx16 | rx64) & (frames['length'] >= 5))[0]
+   start = frames['payload'][rx]
+   mlen = data[start + 2].astype(np.int64)
+   fits = (mlen >= 5) & (mlen <= frames['length'][rx])
+   rx, start, mlen = rx[fits], start[fits], mlen[fits]
+   crc = mrbusCRC16Many(data, start, mlen)
+   sent = data[start + 3].astype(np.uint16) | (data[start + 4].astype(np.uint16) << 8)
+   frames['mrbus_ok'][rx] = crc == sent
+
+   return frames, data
+
+def dropOverlaps(s, length, end):
+   # unescaped logs can have 0x7E inside a frame, keep the first of any overlap
+   keep = np.zeros(len(s), dtype=bool)
+   last = -1
+   for k in range(len(s)):
+      if s[k] > last:
+         keep[k] = True
+         last = end[k]
+   return s[keep], length[keep], end[keep]
+
+def captureSummary(frames):
+   types = {}
+   for t, c in zip(*np.unique(frames['type'], return_counts=True)):
+      types["0x%02X" % t] = int(c)
+
+   sources = {}
+   rx = frames[np.isin(frames['type'], (0x80, 0x81))]
+   for src in np.unique(rx['source']):
+      f = rx[rx['source'] == src]
+      sources["%X" % src] = {'frames': int(len(f)), 'rssi_min': -int(f['rssi'].max()),
+                             'rssi_mean': -round(float(f['rssi'].mean()), 1), 'rssi_max': -int(f['rssi'].min()),
+                             'mrbus_ok': int(f['mrbus_ok'].sum())}
+
+   return {'frames': int(len(frames)), 'types': types, 'sources': sources}
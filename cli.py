@@ -0,0 +1,413 @@
+"""
+Protothrottle Receiver command line tool
+
+Headless front end to xbeeController for scripting the workbench PC.
+This never imports toga, so it is ready to talk to the Xbee as soon as the
+serial port is open.  Every command prints one JSON object per line.
+
+   python -m ptreceiver.cli scan
+   python -m ptreceiver.cli query VR
+   python -m ptreceiver.cli read  --dest 0x30 --addr 0 --len 12
+   python -m ptreceiver.cli write --dest 0x30 --addr 4 --data 1,2,3
+   python -m ptreceiver.cli dump  --dest 0x30 --size 256 --out receiver.bin
+   python -m ptreceiver.cli image --dest 0x30 --file receiver.bin
+   python -m ptreceiver.cli profile save switcher --set addr=1234 --set srvm=ESC
+   python -m ptreceiver.cli profile capture switcher --from 0013A20040A1B2C3
+   python -m ptreceiver.cli profile apply switcher --mac 0013A20040A1B2C4 --override 0013A20040A1B2C4:0x12=D204
+   python -m ptreceiver.cli decode capture.bin
+   python -m ptreceiver.cli monitor --time 10
+   python -m ptreceiver.cli batch < jobs.txt
+
+A batch file has one command per line, written the same as on the command
+line without the program name.  Blank lines and lines starting with # are
+skipped.
+"""
+
+import sys
+import json
+import time
+import shlex
+import argparse
+import contextlib
+
+from .xbee import *
+from .xbeepool import xbeePool
+from .remoteat import xbeeRemoteBatch, xbeeDiagnosticsSweep
+from .profiles import profileStore, parseOverrides, applyProfileImage, PROFILE_START, PROFILE_SIZE
+from .eeprom import eepromReadImage, eepromWriteImage
+from .reliable import rttTable, reliableRequest
+from .nodes import nodeRegistry
+from .ptstatus import throttleTable
+
+READ_TIMEOUT = 1.0
+READ_RETRIES = 3
+
+readTimes = rttTable()         # per receiver read timeouts, kept across a batch
+
+##
+## Commands, each takes the open controller and parsed args, returns a dict
+##
+
+def discoverNodes(xb, seconds):
+    xb.clear()
+    xb.xbeeDataQuery('N', 'D')
+    # each local Xbee sends an empty ND response when its discovery is finished,
+    # with a pool wait for all of them
+    remaining = [xb.discoveryRadios()]
+    def finished(p):
+        if p[3] == 0x88 and p[5] == ord('N') and p[6] == ord('D') and p[2] <= 5:
+           remaining[0] -= 1
+        return remaining[0] <= 0
+    packets = xb.xbeeCollectPackets(seconds, until=finished)
+    registry = nodeRegistry()
+    for p in packets:
+        registry.update(p)
+    return registry
+
+def doScan(xb, args):
+    registry = discoverNodes(xb, args.time)
+    return {'command': 'scan', 'nodes': [n.summary() for n in registry.discoveredSince(0)]}
+
+def doQuery(xb, args):
+    cmd = args.cmd.upper()
+    if len(cmd) != 2:
+       raise ValueError("AT command must be two characters")
+    xb.clear()
+    xb.xbeeDataQuery(cmd[0], cmd[1])
+    match = lambda p: p[3] == 0x88 and p[5] == ord(cmd[0]) and p[6] == ord(cmd[1])
+    for p in xb.xbeeCollectPackets(READ_TIMEOUT, until=match):
+        if match(p):
+           value = xbeeFrameATValue(p)
+           if value == None:
+              raise IOError("AT%s returned status %d" % (cmd, p[7]))
+           return {'command': 'query', 'cmd': cmd, 'value': bytes(value).hex()}
+    raise IOError("no response to AT%s" % cmd)
+
+def readBlock(xb, dest, addr, length):
+    def match(p):
+        r = mrbusReadResponse(p)
+        if r != None and r[0] == dest and r[1] == addr:
+           return True
+        return None               # anything else, keep waiting
+
+    send = lambda: xb.xbeeBroadCastRequest(dest, MRBUS_SRC, [ord('R'), addr & 0xFF, (addr >> 8) & 0xFF, length])
+    p = reliableRequest(send, xb.getPacket, match, readTimes, dest, READ_RETRIES - 1)
+    if p != None:
+       return list(mrbusReadResponse(p)[2])
+    raise IOError("no response from receiver %d reading %d" % (dest, addr))
+
+def doRead(xb, args):
+    if args.len < 1 or args.len > MAXREAD:
+       raise ValueError("length must be 1 to %d" % MAXREAD)
+    data = readBlock(xb, args.dest, args.addr, args.len)
+    return {'command': 'read', 'dest': args.dest, 'addr': args.addr, 'data': data}
+
+def doWrite(xb, args):
+    data = [int(d, 0) & 0xFF for d in args.data.split(',')]
+    if len(data) < 1 or len(data) > MAXWRITE:
+       raise ValueError("write is 1 to %d bytes" % MAXWRITE)
+    xb.xbeeBroadCastRequest(args.dest, MRBUS_SRC, [ord('W'), args.addr & 0xFF, (args.addr >> 8) & 0xFF] + data)
+    result = {'command': 'write', 'dest': args.dest, 'addr': args.addr, 'data': data}
+    if args.verify:
+       result['verified'] = readBlock(xb, args.dest, args.addr, len(data)) == data
+    return result
+
+def doDump(xb, args):
+    xb.clear()
+    image, missing = eepromReadImage(xb, args.dest, args.start, args.size)
+    if len(missing) > 0:
+       raise IOError("no response from receiver %d reading %s" % (args.dest, ','.join(str(a) for a in missing)))
+    result = {'command': 'dump', 'dest': args.dest, 'start': args.start, 'data': image}
+    if args.out:
+       with open(args.out, 'wb') as f:
+          f.write(bytes(image))
+       result['out'] = args.out
+    return result
+
+def doImage(xb, args):
+    with open(args.file, 'rb') as f:
+       image = f.read()
+    if len(image) == 0:
+       raise ValueError("%s is empty" % args.file)
+    result = eepromWriteImage(xb, args.dest, image, args.start)
+    result['command'] = 'image'
+    result['dest'] = args.dest
+    result['start'] = args.start
+    return result
+
+def doRemote(xb, args):
+    batch = xbeeRemoteBatch(xb)
+    for mac in args.mac:
+        for setting in args.set:
+            cmd, value = setting.split('=', 1)
+            if len(cmd) != 2:
+               raise ValueError("AT command must be two characters")
+            batch.queue(mac, cmd, bytes.fromhex(value))
+    xb.clear()
+    result = batch.send(write=args.write)
+    result['command'] = 'remote'
+    return result
+
+def doDiag(xb, args):
+    macs = args.mac
+    if not macs:
+       macs = [n['mac'] for n in doScan(xb, args)['nodes']]
+    xb.clear()
+    table = xbeeDiagnosticsSweep(xb, macs)
+    return {'command': 'diag', 'nodes': table}
+
+def doMonitor(xb, args):
+    table = throttleTable()
+    xb.clear()
+    deadline = time.monotonic() + args.time
+    while time.monotonic() < deadline:
+        p = xb.getPacket()
+        if p != None:
+           table.update(p)
+    return {'command': 'monitor', 'decoded': table.decoded, 'crc_errors': table.crcErrors,
+            'throttles': [table.throttles[src].summary() for src in sorted(table.throttles)]}
+
+def doDecode(xb, args):
+    # numpy is only loaded for this one
+    from .capture import decodeCapture, captureSummary, np
+
+    frames, data = decodeCapture(args.file, escaped=not args.unescaped, baud=args.line_baud)
+    result = captureSummary(frames)
+    result['command'] = 'decode'
+    if args.out:
+       np.save(args.out, frames)
+       result['out'] = args.out
+    return result
+
+def parseSettings(settings):
+    fields = {}
+    for setting in settings or []:
+        name, value = setting.split('=', 1)
+        fields[name.lower()] = value
+    return fields
+
+# --from is a 16 hex digit MAC or an MRBus address
+def receiverRef(text):
+    if len(text) == 16:
+       return text.upper()
+    return int(text, 0)
+
+# --override MAC:ADDR=HEX[,ADDR=HEX] -> {mac: {addr: [bytes]}}
+def parseMacOverrides(items):
+    overrides = {}
+    for item in items or []:
+        mac, spec = item.split(':', 1)
+        overrides.setdefault(mac.strip().upper(), {}).update(parseOverrides(spec))
+    return overrides
+
+def doProfile(xb, args):
+    store = profileStore()
+    if args.action == 'list':
+       return {'command': 'profile', 'profiles': store.names(), 'macs': store.macs}
+
+    if args.name == None:
+       raise ValueError("profile %s needs a name" % args.action)
+
+    if args.action == 'save':
+       fields = dict(store.get(args.name) or {})
+       fields.update(parseSettings(args.set))
+       store.save(args.name, fields, args.mac[0] if args.mac else None)
+       return {'command': 'profile', 'name': args.name, 'fields': store.get(args.name)}
+
+    if args.action == 'capture':
+       if args.source == None:
+          raise ValueError("profile capture needs --from")
+       ref = receiverRef(args.source)
+       nodes = discoverNodes(xb, args.time) if isinstance(ref, str) else None
+       xb.clear()
+       image, missing = eepromReadImage(xb, ref, args.start, args.size, nodes=nodes)
+       if len(missing) > 0:
+          raise IOError("no response from receiver %s reading %s" % (args.source, ','.join(str(a) for a in missing)))
+       store.saveImage(args.name, args.start, image, ref)
+       return {'command': 'profile', 'name': args.name, 'image': store.imageSummary(args.name)}
+
+    if args.name not in store.names():
+       raise ValueError("no profile %s" % args.name)
+
+    if args.action == 'show':
+       return {'command': 'profile', 'name': args.name, 'fields': store.get(args.name),
+               'image': store.imageSummary(args.name)}
+
+    if args.action == 'apply':
+       saved = store.image(args.name)
+       if saved == None:
+          raise ValueError("profile %s has no image, capture one first" % args.name)
+       if not args.mac:
+          raise ValueError("profile apply needs --mac")
+       start, image = saved
+       nodes = discoverNodes(xb, args.time)
+       result = applyProfileImage(xb, args.mac, start, image, parseMacOverrides(args.override), nodes)
+       store.remember([m for m in result['nodes'] if result['nodes'][m]['ok']], args.name)
+       result['command'] = 'profile'
+       result['name'] = args.name
+       return result
+
+    # delete
+    store.delete(args.name)
+    return {'command': 'profile', 'deleted': args.name}
+
+def doBatch(xb, args):
+    ok = True
+    for line in sys.stdin:
+        line = line.strip()
+        if line == "" or line.startswith('#'):
+           continue
+        try:
+           sub = buildParser().parse_args(shlex.split(line))
+        except SystemExit:
+           emit({'error': 'bad command', 'line': line})
+           ok = False
+           continue
+        if sub.func == doBatch:
+           emit({'error': 'nested batch', 'line': line})
+           ok = False
+           continue
+        ok = runCommand(xb, sub) and ok
+    return None if ok else False
+
+##
+## Plumbing
+##
+
+def emit(result):
+    sys.stdout.write(json.dumps(result) + "\n")
+    sys.stdout.flush()
+
+def runCommand(xb, args):
+    try:
+       # xbeeController prints its traffic, keep stdout clean for the JSON
+       with contextlib.redirect_stdout(sys.stderr):
+          result = args.func(xb, args)
+    except Exception as e:
+       emit({'command': args.command, 'error': str(e)})
+       return False
+    if result is None or result is False:    # batch emits its own results
+       return result is None
+    emit(result)
+    return True
+
+def buildParser():
+    num = lambda s: int(s, 0)
+
+    parser = argparse.ArgumentParser(prog='ptreceiver.cli', description='Protothrottle receiver programmer')
+    parser.add_argument('--port', help='serial port, default is to find the Xbee')
+    parser.add_argument('--baud', type=int, help='negotiate a faster Xbee link, e.g. 115200')
+    parser.add_argument('--all-radios', action='store_true', help='use every Xbee plugged in as one')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('scan', help='network discovery, list receivers')
+    p.add_argument('--time', type=float, default=5.0, help='seconds to wait for answers')
+    p.set_defaults(func=doScan)
+
+    p = sub.add_parser('query', help='query a local AT parameter')
+    p.add_argument('cmd', help='two character AT command, e.g. VR')
+    p.set_defaults(func=doQuery)
+
+    p = sub.add_parser('read', help='read receiver EEPROM')
+    p.add_argument('--dest', type=num, required=True, help='receiver MRBus address')
+    p.add_argument('--addr', type=num, required=True)
+    p.add_argument('--len', type=num, default=1)
+    p.set_defaults(func=doRead)
+
+    p = sub.add_parser('write', help='write receiver EEPROM')
+    p.add_argument('--dest', type=num, required=True, help='receiver MRBus address')
+    p.add_argument('--addr', type=num, required=True)
+    p.add_argument('--data', required=True, help='comma separated bytes')
+    p.add_argument('--verify', action='store_true', help='read back after writing')
+    p.set_defaults(func=doWrite)
+
+    p = sub.add_parser('dump', help='read a block of receiver EEPROM')
+    p.add_argument('--dest', type=num, required=True, help='receiver MRBus address')
+    p.add_argument('--start', type=num, default=0)
+    p.add_argument('--size', type=num, default=256)
+    p.add_argument('--out', help='also save the bytes to a file')
+    p.set_defaults(func=doDump)
+
+    p = sub.add_parser('image', help='write a whole EEPROM image file, read back and fix any differences')
+    p.add_argument('--dest', type=num, required=True, help='receiver MRBus address')
+    p.add_argument('--file', required=True, help='raw image, one byte per EEPROM location')
+    p.add_argument('--start', type=num, default=0, help='EEPROM address of the first byte')
+    p.set_defaults(func=doImage)
+
+    p = sub.add_parser('remote', help='set AT parameters on receiver Xbees, applied once at the end')
+    p.add_argument('--mac', action='append', required=True, help='receiver 64 bit address, repeat for more')
+    p.add_argument('--set', action='append', required=True, help='CMD=HEXVALUE, e.g. CH=0C, repeat for more')
+    p.add_argument('--write', action='store_true', help='save with WR before applying')
+    p.set_defaults(func=doRemote)
+
+    p = sub.add_parser('diag', help='firmware, RSSI, power and channel of every receiver Xbee')
+    p.add_argument('--mac', action='append', help='receiver 64 bit address, default is to scan')
+    p.add_argument('--time', type=float, default=5.0, help='seconds to wait for scan answers')
+    p.set_defaults(func=doDiag)
+
+    p = sub.add_parser('monitor', help='state of every Protothrottle broadcasting')
+    p.add_argument('--time', type=float, default=5.0, help='seconds to listen')
+    p.set_defaults(func=doMonitor)
+
+    p = sub.add_parser('decode', help='decode a raw Xbee serial capture file, no radio needed')
+    p.add_argument('file')
+    p.add_argument('--unescaped', action='store_true', help='capture is API mode 1, no escaping')
+    p.add_argument('--line-baud', type=int, default=38400, help='baud rate of the capture, only used to estimate offset_s (seconds into the log, idle time not counted)')
+    p.add_argument('--out', help='save the frame table as a .npy file')
+    p.set_defaults(func=doDecode)
+
+    p = sub.add_parser('profile', help='receiver profiles, capture and apply need the radio')
+    p.add_argument('action', choices=['save', 'list', 'show', 'delete', 'capture', 'apply'])
+    p.add_argument('name', nargs='?')
+    p.add_argument('--set', action='append', help='field=value for save, e.g. addr=1234, repeat for more')
+    p.add_argument('--mac', action='append', help='receiver 64 bit address, saved from or to apply to, repeat for more')
+    p.add_argument('--from', dest='source', help='capture: reference receiver, 64 bit address or MRBus address')
+    p.add_argument('--start', type=num, default=PROFILE_START, help='capture: first EEPROM address')
+    p.add_argument('--size', type=num, default=PROFILE_SIZE, help='capture: bytes to read')
+    p.add_argument('--override', action='append', help='apply: MAC:ADDR=HEX[,ADDR=HEX] raw EEPROM bytes for one receiver, repeat for more')
+    p.add_argument('--time', type=float, default=5.0, help='seconds to wait for scan answers')
+    p.set_defaults(func=doProfile)
+
+    p = sub.add_parser('batch', help='run commands read from stdin')
+    p.set_defaults(func=doBatch)
+
+    return parser
+
+def needsRadio(args):
+    if args.func == doDecode:
+       return False
+    if args.func == doProfile:
+       return args.action in ('capture', 'apply')
+    return True
+
+def main(argv=None):
+    args = buildParser().parse_args(argv)
+
+    if not needsRadio(args):
+       return 0 if runCommand(None, args) else 1
+
+    with contextlib.redirect_stdout(sys.stderr):
+       if args.all_radios:
+          xb = xbeePool()
+       else:
+          xb = xbeeController(args.port)
+    if xb.getStatus() == None:
+       emit({'command': args.command, 'error': 'no Xbee found'})
+       return 1
+
+    try:
+       if args.baud:
+          with contextlib.redirect_stdout(sys.stderr):
+             got = xb.xbeeNegotiateBaud(args.baud)
+          if got != args.baud:
+             print ("unable to switch the Xbee link to %d baud, still at %d" % (args.baud, got), file=sys.stderr)
+             emit({'command': args.command, 'error': 'baud rate %d refused, link is at %d' % (args.baud, got)})
+             return 1
+       ok = runCommand(xb, args)
+    finally:
+       with contextlib.redirect_stdout(sys.stderr):
+          xb.close()
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,215 @@
+
+# Whole EEPROM images to and from a receiver over MRBus
+#
+# A receiver (dest) is either its MRBus address, reached with the broadcast
+# frames of xbeeBroadCastRequest, or the MAC of its Xbee, reached with a
+# directed 0x00 frame carrying the same MRBus packet.  Replies are matched by
+# MRBus source for the first, by the frame's source for the second, with 16
+# bit sources looked up in a nodeRegistry.
+#
+# Writes are 'W' packets, up to 9 data bytes each, with a frame ID so the
+# local Xbee's 0x89 transmit status paces them.  Up to 'window' are in flight
+# instead of one field at a time, and one pass can cover several receivers.
+#
+# Reads are 'R' packets of up to 12 bytes, also windowed, matched back by
+# address from the receiver's 'r' replies and retried if they go missing.
+#
+# eepromWriteImage writes the image and hands over to eepromVerifyImage,
+# which reads the whole thing back, rewrites only the ranges that came back
+# different or never came back at all and finishes with a CRC of the read
+# back image against the file.  The CRC is only worked out when every byte
+# was read back.
+
+import time
+import zlib
+
+from .xbee import *
+from .remoteat import macBytes, macString
+
+EE_WINDOW    = 4
+EE_TIMEOUT   = 1.0
+EE_RETRIES   = 3
+EE_PASSES    = 3               # rewrite passes before giving up
+
+def eepromChunks(start, image, size):
+   chunks = []
+   for i in range(0, len(image), size):
+      chunks.append((start + i, list(image[i:i+size])))
+   return chunks
+
+def eepromCRC(image):
+   return zlib.crc32(bytes(image)) & 0xFFFFFFFF
+
+##
+## One MRBus request to a receiver, and the (addr, data) of its 'r' reply
+##
+
+def eepromSend(xb, dest, data, fid=0x00):
+   if isinstance(dest, int):
+      xb.xbeeBroadCastRequest(dest, MRBUS_SRC, data, fid)
+   else:
+      xb.xbeeTransmitDataFrame(macBytes(dest), mrbusPacket(MRBUS_BROADCAST, MRBUS_SRC, data), fid)
+
+def eepromReply(p, dest, nodes=None):
+   r = mrbusReadResponse(p)
+   if r == None:
+      return None
+   if isinstance(dest, int):
+      return r[1:] if r[0] == dest else None
+   mac, addr16 = xbeeFrameSource(p)
+   if mac == None and addr16 != None and nodes != None:
+      node = nodes.find16(addr16)
+      mac = None if node == None else node.mac
+   return r[1:] if mac == macString(dest) else None
+
+##
+## Write [(dest, addr, data), ...], returns how many the local Xbee sent
+##
+
+def eepromWriteMany(xb, writes, window=EE_WINDOW, timeout=EE_TIMEOUT):
+   pending = {}                   ## frame ID -> time sent
+   sent = 0
+   nextWrite = 0
+   fid = 0
+
+   while nextWrite < len(writes) or len(pending) > 0:
+      while nextWrite < len(writes) and len(pending) < window:
+         fid = fid % 255 + 1
+         while fid in pending:
+            fid = fid % 255 + 1
+         dest, addr, data = writes[nextWrite]
+         eepromSend(xb, dest, [ord('W'), addr & 0xFF, (addr >> 8) & 0xFF] + list(data), fid)
+         pending[fid] = time.monotonic()
+         nextWrite = nextWrite + 1
+
+      p = xb.getPacket()
+      if p != None and len(p) >= 7 and p[3] == 0x89 and p[4] in pending:
+         del pending[p[4]]
+         if p[5] == 0:
+            sent = sent + 1
+
+      now = time.monotonic()
+      for f in [f for f in pending if now - pending[f] > timeout]:
+         del pending[f]
+
+   return sent
+
+# chunks [(addr, data), ...] all to one receiver
+def eepromWriteChunks(xb, dest, chunks, window=EE_WINDOW, timeout=EE_TIMEOUT):
+   return eepromWriteMany(xb, [(dest, addr, data) for addr, data in chunks], window, timeout)
+
+##
+## Read ranges [(addr, length), ...], returns {addr: [bytes]}, None where
+## the receiver never answered
+##
+
+def eepromReadRanges(xb, dest, ranges, window=EE_WINDOW, timeout=EE_TIMEOUT, retries=EE_RETRIES, nodes=None):
+   results = {}
+   todo = list(ranges)
+   tries = {}
+   pending = {}                   ## addr -> (length, time sent)
+
+   while len(todo) > 0 or len(pending) > 0:
+      while len(todo) > 0 and len(pending) < window:
+         addr, length = todo.pop(0)
+         eepromSend(xb, dest, [ord('R'), addr & 0xFF, (addr >> 8) & 0xFF, length])
+         pending[addr] = (length, time.monotonic())
+         tries[addr] = tries.get(addr, 0) + 1
+
+      p = xb.getPacket()
+      r = None if p == None else eepromReply(p, dest, nodes)
+      if r != None and r[0] in pending:
+         results[r[0]] = list(r[1])
+         del pending[r[0]]
+
+      now = time.monotonic()
+      for addr in [a for a in pending if now - pending[a][1] > timeout]:
+         length = pending.pop(addr)[0]
+         if tries[addr] < retries:
+            todo.append((addr, length))
+         else:
+            results[addr] = None
+
+   return results
+
+##
+## Read size bytes from start, returns (image, missing) with None in the
+## image for every byte that never came back and missing the addresses of
+## the reads that didn't
+##
+
+def eepromReadImage(xb, dest, start, size, window=EE_WINDOW, timeout=EE_TIMEOUT, nodes=None):
+   ranges = [(addr, len(data)) for addr, data in eepromChunks(start, bytes(size), MAXREAD)]
+   got = eepromReadRanges(xb, dest, ranges, window, timeout, nodes=nodes)
+   image = []
+   missing = []
+   for addr, length in ranges:
+      data = got.get(addr)
+      if data == None or len(data) != length:
+         missing.append(addr)
+         data = [None] * length
+      image.extend(data)
+   return image, missing
+
+def flaggedRanges(flags):
+   # [(first, last), ...] offsets where flags is true, last is exclusive
+   found = []
+   first = None
+   for i in range(len(flags)):
+      if flags[i]:
+         if first == None:
+            first = i
+      elif first != None:
+         found.append((first, i))
+         first = None
+   if first != None:
+      found.append((first, len(flags)))
+   return found
+
+def mismatchedRanges(image, readback):
+   # where readback differs, a byte never read back (None) differs too
+   return flaggedRanges([image[i] != readback[i] for i in range(len(image))])
+
+##
+## Write a whole image and verify it
+##
+
+def eepromWriteImage(xb, dest, image, start=0, window=EE_WINDOW, timeout=EE_TIMEOUT, passes=EE_PASSES, nodes=None):
+   image = list(image)
+   xb.clear()
+   eepromWriteChunks(xb, dest, eepromChunks(start, image, MAXWRITE), window, timeout)
+   return eepromVerifyImage(xb, dest, image, start, window, timeout, passes, nodes)
+
+# read an image already written back, rewrite what differs, returns the report
+def eepromVerifyImage(xb, dest, image, start=0, window=EE_WINDOW, timeout=EE_TIMEOUT, passes=EE_PASSES, nodes=None):
+   image = list(image)
+   readback, missing = eepromReadImage(xb, dest, start, len(image), window, timeout, nodes)
+
+   rewritten = 0
+   for attempt in range(passes):
+      bad = mismatchedRanges(image, readback)
+      if len(bad) == 0:
+         break
+      chunks = []
+      for first, last in bad:
+         chunks.extend(eepromChunks(start + first, image[first:last], MAXWRITE))
+      rewritten = rewritten + len(chunks)
+      eepromWriteChunks(xb, dest, chunks, window, timeout)
+
+      # read back just what we rewrote
+      ranges = []
+      for first, last in bad:
+         ranges.extend((addr, len(data)) for addr, data in eepromChunks(start + first, image[first:last], MAXREAD))
+      got = eepromReadRanges(xb, dest, ranges, window, timeout, nodes=nodes)
+      for addr, length in ranges:
+         data = got.get(addr)
+         if data != None and len(data) == length:
+            readback[addr - start:addr - start + length] = data
+
+   bad = mismatchedRanges(image, readback)
+   missing = flaggedRanges([b == None for b in readback])
+   readbackCRC = None if len(missing) > 0 else eepromCRC(readback)
+   return {'ok': len(bad) == 0 and readbackCRC == eepromCRC(image), 'size': len(image), 'crc': "%08X" % eepromCRC(image),
+           'readback_crc': None if readbackCRC == None else "%08X" % readbackCRC, 'rewritten': rewritten,
+           'bad': [[start + first, start + last] for first, last in bad],
+           'missing': [[start + first, start + last] for first, last in missing]}
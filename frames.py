@@ -0,0 +1,155 @@
+
+# Xbee API frame fields and MRBus packets
+#
+# Everything here works on frames as the lists of bytes getPacket returns (or
+# the Android side assembles out of bulkTransfer reads), on the API mode 2
+# escaping they travel in, and on MRBus packets as lists of bytes.  There is
+# no serial port or Xbee in here, so the app imports it directly on Android
+# too, and xbee.py re-exports all of it for the PC code.
+
+## MRBUS Protothrottle utility routines
+
+MRBUS_SRC = 0xFE               # our MRBus address when talking to receivers
+MRBUS_BROADCAST = 0xFF         # MRBus destination of a frame already addressed by MAC
+MAXREAD   = 12                 # max EEPROM bytes per 'R'
+MAXWRITE  = 9                  # 12 byte payload less 'W', LSB, MSB
+
+def mrbusCRC16Calculate(data):
+   return mrbusCRC16(data, 0, data[2])
+
+def mrbusCRC16Update(crc, a):
+   MRBus_CRC16_HighTable = [ 0x00, 0xA0, 0xE0, 0x40, 0x60, 0xC0, 0x80, 0x20, 0xC0, 0x60, 0x20, 0x80, 0xA0, 0x00, 0x40, 0xE0 ]
+   MRBus_CRC16_LowTable =  [ 0x00, 0x01, 0x03, 0x02, 0x07, 0x06, 0x04, 0x05, 0x0E, 0x0F, 0x0D, 0x0C, 0x09, 0x08, 0x0A, 0x0B ]
+   crc16_h = (crc>>8) & 0xFF
+   crc16_l = crc & 0xFF
+   i = 0
+   while i < 2:
+      if i != 0:
+         w = ((crc16_h << 4) & 0xF0) | ((crc16_h >> 4) & 0x0F)
+         t = (w ^ a) & 0x0F
+      else:
+         t = (crc16_h ^ a) & 0xF0
+         t = ((t << 4) & 0xF0) | ((t >> 4) & 0x0F)
+      crc16_h = (crc16_h << 4) & 0xFF
+      crc16_h = crc16_h | (crc16_l >> 4)
+      crc16_l = (crc16_l << 4) & 0xFF
+      crc16_h = crc16_h ^ MRBus_CRC16_HighTable[t]
+      crc16_l = crc16_l ^ MRBus_CRC16_LowTable[t]
+      i = i + 1
+   return (crc16_h<<8) | crc16_l
+
+## The same CRC a byte at a time.  MRBUS_CRC_TABLE[a] is mrbusCRC16Update(0, a),
+## mrbusCRC16 runs it over the packet of length bytes at buf[start], skipping
+## the CRC bytes themselves
+
+MRBUS_CRC_TABLE = [mrbusCRC16Update(0, a) for a in range(256)]
+
+def mrbusCRC16(buf, start, length):
+   crc = 0
+   for i in range(start, start + 3):
+      crc = ((crc << 8) & 0xFFFF) ^ MRBUS_CRC_TABLE[(crc >> 8) ^ buf[i]]
+   for i in range(start + 5, start + length):
+      crc = ((crc << 8) & 0xFFFF) ^ MRBUS_CRC_TABLE[(crc >> 8) ^ buf[i]]
+   return crc
+
+## XBee API frame field helpers, packets are lists as returned by getPacket
+
+def xbeeFrameMac(data, first=10):
+   mac = ""
+   for i in range(first, first + 8):      ## 64 bit address, 10 in an ND response
+      mac = mac + "{:02X}".format(data[i])
+   return mac
+
+def xbeeFrameNodeID(data, first=19):
+   nodeid = ""
+   for i in range(first, len(data)-1):    ## ascii node id, zero terminated, 19 in an ND response
+      if data[i] == 0:
+         break
+      nodeid = nodeid + chr(data[i])
+   return nodeid.strip()
+
+def xbeeFrameATValue(data):
+   if len(data) < 9 or data[7] != 0:      ## 0x88 AT response, status byte must be OK
+      return None
+   return data[8:-1]
+
+def xbeeFrameSource(data):
+   t = data[3]                            ## returns (64 bit mac, 16 bit address) of the sender
+   if t == 0x80 and len(data) > 12:       ## receive 64 bit
+      return xbeeFrameMac(data, 4), None
+   if t == 0x81 and len(data) > 6:        ## receive 16 bit
+      return None, (data[4] << 8) | data[5]
+   if t == 0x88 and len(data) > 18 and data[2] > 5:   ## ND response
+      return xbeeFrameMac(data), (data[8] << 8) | data[9]
+   if t == 0x97 and len(data) > 15:       ## remote AT response
+      return xbeeFrameMac(data, 5), (data[13] << 8) | data[14]
+   return None, None
+
+def mrbusPacket(dest, src, data):
+   pkt = []
+   pkt.append(dest)           # 0 - Destination
+   pkt.append(src)            # 1 - Source
+   pkt.append(len(data) + 5)  # 2 - Length
+   pkt.append(0)              # 3 - CRC Low
+   pkt.append(0)              # 4 - CRC High
+
+   for b in data:
+      pkt.append(int(b) & 0xFF)
+
+   # this is specific to the mrbus implementation in the PT
+   crc = mrbusCRC16Calculate(pkt)
+   pkt[3] = 0xFF & crc
+   pkt[4] = 0xFF & (crc >> 8)
+   return pkt
+
+def mrbusFramePacket(data):
+   if len(data) >= 15 and data[3] == 0x81:   ## 0x81 receive 16 bit, MRBus starts after options
+      return data[8:-1]
+   if len(data) >= 21 and data[3] == 0x80:   ## 0x80 receive 64 bit
+      return data[14:-1]
+   return None
+
+def mrbusReadResponse(data):
+   pkt = mrbusFramePacket(data)           ## 'r', LSB, MSB, LEN, DATA ... reply to an 'R'
+   if pkt == None or len(pkt) < 9 or pkt[5] != ord('r'):
+      return None
+   addr = pkt[6] | (pkt[7] << 8)
+   return pkt[1], addr, pkt[9:9+pkt[8]]
+
+## API mode 2 (AP=2), everything after the 0x7E is escaped on the wire
+
+XBEE_ESCAPED = frozenset([0x7E, 0x7D, 0x11, 0x13])
+
+def xbeeEscapeFrame(frame):
+   txBufferEscaped = [ frame[0] ]
+   for b in frame[1:]:
+      if b in XBEE_ESCAPED:
+         txBufferEscaped.append(0x7D)
+         txBufferEscaped.append(b ^ 0x20)
+      else:
+         txBufferEscaped.append(b)
+   return bytes(txBufferEscaped)
+
+def xbeeUnescape(raw):
+   # a 0x7D at the very end is kept, its byte hasn't arrived yet
+   data = bytearray()
+   escaped = False
+   for b in raw:
+      if escaped:
+         data.append(b ^ 0x20)
+         escaped = False
+      elif b == 0x7D:
+         escaped = True
+      else:
+         data.append(b)
+   if escaped:
+      data.append(0x7D)
+   return bytes(data)
+
+# ATBD parameter for the standard rates, anything else is sent as the rate itself
+XBEE_BD = { 1200: 0, 2400: 1, 4800: 2, 9600: 3, 19200: 4, 38400: 5, 57600: 6, 115200: 7 }
+
+def xbeeBDParam(baud):
+   if baud in XBEE_BD:
+      return bytes([XBEE_BD[baud]])
+   return baud.to_bytes(4, 'big')
@@ -0,0 +1,126 @@
+
+# Rolling link quality for each node we hear, from the RSSI byte every
+# received frame already carries.  No extra radio traffic.
+#
+# Each node keeps the last LINK_WINDOW samples in fixed size rings, a running
+# sum for the mean and monotonic queues for min/max, so an update is O(1)
+# (amortized for min/max) and memory per node never grows.  The number of
+# nodes is capped too, the one heard from longest ago is dropped first.
+#
+# Nodes are keyed by MAC once the registry knows them, by 16 bit address
+# until then, see trackLinkQuality in app.py.  Frames are tracked on the
+# radio's executor thread and labels drawn on the UI thread, so the tracker
+# takes a lock around every access.
+
+import time
+import threading
+from collections import deque, OrderedDict
+
+LINK_WINDOW    = 32            # samples per node
+LINK_MAX_NODES = 256
+
+class linkStats:
+    __slots__ = ('size', 'rssi', 'when', 'count', 'seq', 'total', 'lowq', 'highq', 'lastSeen')
+
+    def __init__(self, size=LINK_WINDOW):
+        self.size     = size
+        self.rssi     = [0] * size       # ring of dBm values
+        self.when     = [0.0] * size     # ring of arrival times
+        self.count    = 0                # samples in the ring
+        self.seq      = 0                # samples ever added
+        self.total    = 0                # sum of the ring, for the mean
+        self.lowq     = deque()          # (seq, dBm) increasing, front is the min
+        self.highq    = deque()          # (seq, dBm) decreasing, front is the max
+        self.lastSeen = None
+
+    def add(self, dbm, now):
+        slot = self.seq % self.size
+        if self.count == self.size:
+           self.total -= self.rssi[slot]     # oldest sample drops out
+        else:
+           self.count += 1
+        self.rssi[slot] = dbm
+        self.when[slot] = now
+        self.total += dbm
+
+        oldest = self.seq - self.size
+        while self.lowq and self.lowq[-1][1] >= dbm:
+            self.lowq.pop()
+        self.lowq.append((self.seq, dbm))
+        if self.lowq[0][0] <= oldest:
+           self.lowq.popleft()
+        while self.highq and self.highq[-1][1] <= dbm:
+            self.highq.pop()
+        self.highq.append((self.seq, dbm))
+        if self.highq[0][0] <= oldest:
+           self.highq.popleft()
+
+        self.seq += 1
+        self.lastSeen = now
+
+    def minimum(self):
+        return self.lowq[0][1]
+
+    def maximum(self):
+        return self.highq[0][1]
+
+    def mean(self):
+        return self.total / self.count
+
+    def rate(self):
+        # frames per second across the ring
+        if self.count < 2:
+           return 0.0
+        first = self.when[(self.seq - self.count) % self.size]
+        span = self.lastSeen - first
+        if span <= 0:
+           return 0.0
+        return (self.count - 1) / span
+
+    def summary(self):
+        return {'min': self.minimum(), 'mean': round(self.mean(), 1), 'max': self.maximum(),
+                'rate': round(self.rate(), 2), 'lastSeen': self.lastSeen, 'samples': self.count}
+
+class linkQualityTracker:
+    def __init__(self, window=LINK_WINDOW, maxNodes=LINK_MAX_NODES):
+        self.window   = window
+        self.maxNodes = maxNodes
+        self.nodes    = OrderedDict()    # key -> linkStats, least recently heard first
+        self.lock     = threading.Lock()
+
+    # rssi is the Xbee RSSI byte, -dBm
+    def update(self, key, rssi, now=None):
+        if now == None:
+           now = time.monotonic()
+        with self.lock:
+           stats = self.nodes.get(key)
+           if stats == None:
+              if len(self.nodes) >= self.maxNodes:
+                 self.nodes.popitem(last=False)
+              stats = linkStats(self.window)
+              self.nodes[key] = stats
+           else:
+              self.nodes.move_to_end(key)
+           stats.add(-rssi, now)
+
+    def get(self, key):
+        with self.lock:
+           return self.nodes.get(key)
+
+    def summary(self, key):
+        with self.lock:
+           stats = self.nodes.get(key)
+           if stats == None:
+              return None
+           return stats.summary()
+
+    def describe(self, key, now=None):
+        # short text for a button, "-48 dBm (-61/-44) 2.0/s 3s ago"
+        if now == None:
+           now = time.monotonic()
+        with self.lock:
+           stats = self.nodes.get(key)
+           if stats == None:
+              return "no signal data"
+           return "%d dBm (%d/%d) %.1f/s %ds ago" % (round(stats.mean()), stats.minimum(), stats.maximum(),
+                                                     stats.rate(), int(now - stats.lastSeen))
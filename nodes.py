@@ -0,0 +1,147 @@
+
+# Every Xbee node we know about, in one place
+#
+# Nodes are indexed by 64 bit MAC, 16 bit network address (MY) and ASCII
+# node ID.  The registry is fed every frame read from our Xbee: ND responses
+# give all three, 0x80 receive frames and 0x97 remote AT responses give the
+# MAC, 0x81 receive frames only the 16 bit address so they just mark a node
+# we already know as heard.  Lookups are dictionary hits, nothing is rescanned
+# or parsed from a string.
+#
+# Listeners get ('added', node) the first time a MAC is seen and
+# ('changed', node) when its 16 bit address or node ID changes.
+#
+# The app feeds it from frameSeen, Android and PC alike, and builds transmit
+# frames from node.address.  Frames arrive on reader and executor threads
+# while the UI thread looks nodes up, so the indexes are only touched under
+# a lock.  Listeners are called after it is released.
+
+import time
+import threading
+
+from .frames import xbeeFrameMac, xbeeFrameNodeID
+
+NO_ADDR16 = 0xFFFE             # MY of a node that only uses its 64 bit address
+
+class xbeeNode:
+    __slots__ = ('mac', 'address', 'addr16', 'nodeId', 'discovered', 'lastSeen')
+
+    def __init__(self, mac):
+        self.mac        = mac                          # "0013A20040A1B2C3"
+        self.address    = list(bytes.fromhex(mac))     # the same as 8 bytes, for transmit frames
+        self.addr16     = None
+        self.nodeId     = ""
+        self.discovered = None                         # time of the last ND response
+        self.lastSeen   = None                         # time of the last frame of any kind
+
+    def summary(self):
+        return {'mac': self.mac, 'addr16': self.addr16, 'id': self.nodeId}
+
+class nodeRegistry:
+    def __init__(self):
+        self.byMac     = {}            # mac string -> xbeeNode
+        self.by16      = {}            # 16 bit address -> xbeeNode
+        self.byId      = {}            # node ID -> xbeeNode, the last one to claim it
+        self.listeners = []
+        self.lock      = threading.Lock()
+
+    def subscribe(self, callback):
+        self.listeners.append(callback)
+
+    def unsubscribe(self, callback):
+        if callback in self.listeners:
+           self.listeners.remove(callback)
+
+    def notify(self, event, node):
+        for callback in list(self.listeners):
+            callback(event, node)
+
+    ##
+    ## Lookups
+    ##
+
+    def get(self, mac):
+        with self.lock:
+           return self.byMac.get(mac.upper())
+
+    def find16(self, addr16):
+        with self.lock:
+           return self.by16.get(addr16)
+
+    def findId(self, nodeId):
+        with self.lock:
+           return self.byId.get(nodeId)
+
+    def nodes(self):
+        with self.lock:
+           return list(self.byMac.values())
+
+    def discoveredSince(self, when):
+        with self.lock:
+           return [n for n in self.byMac.values() if n.discovered != None and n.discovered >= when]
+
+    ##
+    ## Updates
+    ##
+
+    def learn(self, mac, addr16=None, nodeId=None, now=None, discovered=False):
+        if now == None:
+           now = time.monotonic()
+        with self.lock:
+           node, event = self.index(mac.upper(), addr16, nodeId, now, discovered)
+        if event != None:
+           self.notify(event, node)
+        return node
+
+    def index(self, mac, addr16, nodeId, now, discovered):
+        node = self.byMac.get(mac)
+        event = None
+        if node == None:
+           node = xbeeNode(mac)
+           self.byMac[mac] = node
+           event = 'added'
+
+        if addr16 != None and addr16 != node.addr16:
+           if self.by16.get(node.addr16) is node:
+              del self.by16[node.addr16]
+           node.addr16 = addr16
+           if addr16 != NO_ADDR16:
+              self.by16[addr16] = node
+           event = event or 'changed'
+
+        if nodeId != None and nodeId != node.nodeId:
+           if self.byId.get(node.nodeId) is node:
+              del self.byId[node.nodeId]
+           node.nodeId = nodeId
+           if nodeId != "":
+              self.byId[nodeId] = node
+           event = event or 'changed'
+
+        node.lastSeen = now
+        if discovered:
+           node.discovered = now
+        return node, event
+
+    # data is an API frame as a list of bytes, returns the node it came from if we know it
+    def update(self, data, now=None):
+        if len(data) < 8:
+           return None
+        t = data[3]
+
+        if t == 0x88 and data[5] == ord('N') and data[6] == ord('D') and data[2] > 5 and len(data) > 19:
+           return self.learn(xbeeFrameMac(data), (data[8] << 8) | data[9], xbeeFrameNodeID(data), now, discovered=True)
+
+        if t == 0x80 and len(data) > 13:      # receive 64 bit
+           return self.learn(xbeeFrameMac(data, 4), None, None, now)
+
+        if t == 0x97 and len(data) > 15:      # remote AT response
+           return self.learn(xbeeFrameMac(data, 5), (data[13] << 8) | data[14], None, now)
+
+        if t == 0x81:                         # receive 16 bit
+           with self.lock:
+              node = self.by16.get((data[4] << 8) | data[5])
+              if node != None:
+                 node.lastSeen = time.monotonic() if now == None else now
+           return node
+
+        return None
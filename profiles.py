@@ -0,0 +1,206 @@
+# Receiver profiles
+#
+# A profile is the complete set of settings from the receiver screen
+# (connectToClient), saved under a name, and the EEPROM image of a reference
+# receiver set up that way.  Many receivers get set up the same way and differ
+# only in loco address, so the image is what gets pushed to them.
+#
+# applyProfileImage writes the image to a list of MACs in one pipelined pass,
+# with per receiver overrides laid over it, then reads every receiver back and
+# rewrites what differs (eepromVerifyImage).  Overrides are given as EEPROM
+# address and bytes rather than by field name: the firmware's layout of the
+# screen's fields isn't pinned down, so nothing here guesses at it.
+#
+# Profiles live in ~/.ptreceiver/profiles.json, indexed by name and by the
+# MAC of each receiver a profile was saved from or applied to.
+
+import os
+import json
+
+from .remoteat import macString
+from .eeprom import eepromChunks, eepromWriteMany, eepromVerifyImage, eepromCRC, EE_WINDOW, EE_TIMEOUT
+from .frames import MAXWRITE
+
+PROFILE_FILE = os.path.join(os.path.expanduser('~'), '.ptreceiver', 'profiles.json')
+PROFILE_START = 0               # EEPROM read from the reference receiver
+PROFILE_SIZE  = 256
+
+# name: (kind, largest value), one entry per setting on the receiver screen
+#    letter - a single character
+#    number - 0 up to the largest value, None for no limit
+#    switch - 0 or 1
+#    button - the text of a button that steps through its choices
+PROFILE_FIELDS = {
+    'ptid':  ('letter', None), # Protothrottle ID
+    'base':  ('number', None), # Base ID
+    'addr':  ('number', 9999), # Loco Address
+    'cons':  ('number', 9999), # Consist Address
+    'cond':  ('button', None), # Consist direction
+    'deco':  ('number', 9999), # DCC Address
+    'srvm':  ('button', None), # Servo Mode
+    'svr0':  ('switch', 1),    # Servo 0..2 Reverse
+    'svr1':  ('switch', 1),
+    'svr2':  ('switch', 1),
+    'srvp0': ('number', 99),   # Servo 0..2 Function Code
+    'srvp1': ('number', 99),
+    'srvp2': ('number', 99),
+    'sv0l':  ('number', 1000), # Servo 0..2 Low and High Limits
+    'sv0h':  ('number', 9999),
+    'sv1l':  ('number', 1000),
+    'sv1h':  ('number', 9999),
+    'sv2l':  ('number', 1000),
+    'sv2h':  ('number', 9999),
+    'wdog':  ('number', 99),   # Watch Dog
+}
+
+# value is what the screen or the command line has, returns what gets saved
+def fieldValue(name, value):
+   if name not in PROFILE_FIELDS:
+      raise ValueError("unknown profile field %s" % name)
+   kind, largest = PROFILE_FIELDS[name]
+   if kind == 'letter' or kind == 'button':
+      value = str(value).strip()
+      if value == "" or (kind == 'letter' and len(value) != 1):
+         raise ValueError("%s must be %s" % (name, "one character" if kind == 'letter' else "set"))
+      return value
+   if isinstance(value, str):
+      value = int(value, 0)
+   value = int(value)
+   if value < 0 or (largest != None and value > largest):
+      raise ValueError("%s out of range: %d" % (name, value))
+   return value
+
+##
+## EEPROM overrides, "ADDR=HEX,ADDR=HEX" e.g. "0x12=D204" -> {0x12: [0xD2, 0x04]}
+##
+
+def parseOverrides(text):
+   overrides = {}
+   for item in text.split(','):
+       if item.strip() == "":
+          continue
+       addr, data = item.split('=', 1)
+       data = list(bytes.fromhex(data.strip()))
+       if len(data) == 0:
+          raise ValueError("override %s has no bytes" % item.strip())
+       overrides[int(addr.strip(), 0)] = data
+   return overrides
+
+def overlayImage(start, image, overrides):
+   image = list(image)
+   for addr in sorted(overrides):
+       data = overrides[addr]
+       if addr < start or addr + len(data) > start + len(image):
+          raise ValueError("override at 0x%X is outside the image" % addr)
+       image[addr - start:addr - start + len(data)] = data
+   return image
+
+##
+## Push one image to many receivers, overrides is {mac: {addr: [bytes]}}
+## Returns {'ok', 'nodes': {mac: eepromVerifyImage report}}
+##
+
+def applyProfileImage(xb, macs, start, image, overrides=None, nodes=None, window=EE_WINDOW, timeout=EE_TIMEOUT):
+   if overrides == None:
+      overrides = {}
+   overrides = {macString(m): overrides[m] for m in overrides}
+
+   perMac = []
+   for mac in macs:
+      perMac.append((macString(mac), overlayImage(start, image, overrides.get(macString(mac), {}))))
+
+   # every receiver's writes in one pass, interleaved so each gets its first
+   # chunk before anyone gets a second
+   chunks = [eepromChunks(start, img, MAXWRITE) for mac, img in perMac]
+   writes = []
+   for i in range(max([len(c) for c in chunks] + [0])):
+      for (mac, img), c in zip(perMac, chunks):
+         if i < len(c):
+            writes.append((mac, c[i][0], c[i][1]))
+   xb.clear()
+   eepromWriteMany(xb, writes, window, timeout)
+
+   # then read back and fix each one, replies are matched to one receiver at a time
+   report = {}
+   for mac, img in perMac:
+      report[mac] = eepromVerifyImage(xb, mac, img, start, window, timeout, nodes=nodes)
+   return {'ok': all(report[m]['ok'] for m in report), 'nodes': report}
+
+##
+## Profile store
+##
+
+class profileStore:
+    def __init__(self, path=PROFILE_FILE):
+        self.path = path
+        self.profiles = {}          # name -> {field: value}
+        self.images = {}            # name -> {'start', 'data' as hex, 'from' mac}
+        self.macs = {}              # mac -> name of the profile it was saved from or applied to
+        try:
+           with open(path) as f:
+              saved = json.load(f)
+           self.profiles = saved.get('profiles', {})
+           self.images = saved.get('images', {})
+           self.macs = saved.get('macs', {})
+        except FileNotFoundError:
+           pass
+
+    def write(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'w') as f:
+           json.dump({'profiles': self.profiles, 'images': self.images, 'macs': self.macs}, f, indent=1)
+
+    def names(self):
+        return sorted(set(self.profiles) | set(self.images))
+
+    def get(self, name):
+        return self.profiles.get(name)
+
+    def forMac(self, mac):
+        name = self.macs.get(macString(mac))
+        if name == None:
+           return None, None
+        return name, self.profiles.get(name)
+
+    def save(self, name, fields, mac=None):
+        checked = {}
+        for field in fields:
+            checked[field] = fieldValue(field, fields[field])      # check before we keep it
+        self.profiles[name] = checked
+        if mac != None:
+           self.macs[macString(mac)] = name
+        self.write()
+
+    # the reference receiver's EEPROM, start is the address of image[0]
+    def saveImage(self, name, start, image, mac=None):
+        if mac != None and not isinstance(mac, int):
+           mac = macString(mac)
+           self.macs[mac] = name
+        self.images[name] = {'start': start, 'data': bytes(image).hex(), 'from': mac}
+        self.write()
+
+    # (start, [bytes]) or None if the profile has no image
+    def image(self, name):
+        saved = self.images.get(name)
+        if saved == None:
+           return None
+        return saved['start'], list(bytes.fromhex(saved['data']))
+
+    def imageSummary(self, name):
+        saved = self.images.get(name)
+        if saved == None:
+           return None
+        data = bytes.fromhex(saved['data'])
+        return {'start': saved['start'], 'size': len(data), 'crc': "%08X" % eepromCRC(data), 'from': saved['from']}
+
+    def remember(self, macs, name):
+        for mac in macs:
+            self.macs[macString(mac)] = name
+        self.write()
+
+    def delete(self, name):
+        self.profiles.pop(name, None)
+        self.images.pop(name, None)
+        for mac in [m for m in self.macs if self.macs[m] == name]:
+            del self.macs[mac]
+        self.write()
@@ -0,0 +1,139 @@
+
+# Protothrottle status broadcasts
+#
+# Every Protothrottle broadcasts an MRBus 'S' packet with the state of its
+# locomotive several times a second.  throttleTable decodes them straight
+# out of the Xbee 0x81 receive frame with precompiled struct layouts, checks
+# the MRBus CRC with a byte wide table, and keeps one throttleState per
+# throttle that is updated in place, so a busy layout costs no new objects
+# per frame.
+# The Android monitor feeds it the frames it assembles from USB reads, the
+# PC feeds it from pullPacket.  Both run on an executor thread while the UI
+# thread draws rows(), so the table is guarded by a lock.
+
+import time
+import struct
+import threading
+
+from .frames import mrbusCRC16
+
+RX16_MRBUS = 8                 # MRBus packet starts after 81 src src rssi opt
+
+# MRBus header: dest, src, len, CRC (LSB first), packet type
+MRBUS_HEADER = struct.Struct('<BBBHB')
+
+# 'S' status body, right after the type byte.  Must match the Protothrottle
+# firmware: loco address (bit 15 set for a short address), speed (bit 7 set
+# for forward, 0 stop, 1 emergency stop, 2..127 speed steps), functions F31..F0,
+# throttle status flags
+PT_STATUS = struct.Struct('>HBIB')
+
+PT_STATUS_TYPE = ord('S')
+PT_MIN_LENGTH  = MRBUS_HEADER.size + PT_STATUS.size
+
+##
+## Live state of every throttle heard
+##
+
+class throttleState:
+    __slots__ = ('src', 'address', 'shortAddr', 'speed', 'forward', 'estop', 'functions', 'flags',
+                 'rssi', 'frames', 'lastSeen')
+
+    def __init__(self, src):
+        self.src       = src           # MRBus address of the throttle
+        self.address   = 0             # loco address
+        self.shortAddr = False
+        self.speed     = 0             # 0..126
+        self.forward   = True
+        self.estop     = False
+        self.functions = 0             # bit n is Fn
+        self.flags     = 0
+        self.rssi      = 0             # -dBm of the last frame
+        self.frames    = 0
+        self.lastSeen  = None
+
+    def functionList(self):
+        return [f for f in range(32) if self.functions & (1 << f)]
+
+    def summary(self):
+        return {'src': self.src, 'address': self.address, 'short': self.shortAddr, 'speed': self.speed,
+                'forward': self.forward, 'estop': self.estop, 'functions': self.functionList(),
+                'flags': self.flags, 'rssi': -self.rssi, 'frames': self.frames, 'lastSeen': self.lastSeen}
+
+class throttleTable:
+    def __init__(self):
+        self.throttles = {}            # MRBus source address -> throttleState
+        self.buf       = bytearray(256)  # every frame is decoded from here
+        self.decoded   = 0
+        self.crcErrors = 0
+        self.ignored   = 0
+        self.lock      = threading.Lock()
+
+    # data is an Xbee API frame as a list of bytes, returns the throttle it updated or None
+    def update(self, data, now=None):
+        with self.lock:
+           return self.decode(data, now)
+
+    def decode(self, data, now):
+        n = len(data)
+        if n < RX16_MRBUS + PT_MIN_LENGTH + 1 or n > len(self.buf) or data[3] != 0x81:
+           self.ignored += 1
+           return None
+
+        buf = self.buf
+        buf[0:n] = data
+        dest, src, length, crc, ptype = MRBUS_HEADER.unpack_from(buf, RX16_MRBUS)
+        if ptype != PT_STATUS_TYPE or length < PT_MIN_LENGTH or RX16_MRBUS + length > n - 1:
+           self.ignored += 1
+           return None
+        if mrbusCRC16(buf, RX16_MRBUS, length) != crc:
+           self.crcErrors += 1
+           return None
+
+        address, speed, functions, flags = PT_STATUS.unpack_from(buf, RX16_MRBUS + MRBUS_HEADER.size)
+
+        t = self.throttles.get(src)
+        if t == None:
+           t = throttleState(src)
+           self.throttles[src] = t
+        t.shortAddr = (address & 0x8000) != 0
+        t.address   = address & 0x3FFF
+        t.forward   = (speed & 0x80) != 0
+        t.estop     = (speed & 0x7F) == 1
+        t.speed     = 0 if (speed & 0x7F) < 2 else (speed & 0x7F) - 1
+        t.functions = functions
+        t.flags     = flags
+        t.rssi      = buf[6]
+        t.frames   += 1
+        t.lastSeen  = time.monotonic() if now == None else now
+        self.decoded += 1
+        return t
+
+    def get(self, src):
+        with self.lock:
+           return self.throttles.get(src)
+
+    def count(self):
+        with self.lock:
+           return len(self.throttles)
+
+    # one row per throttle for a table widget, most recently heard first
+    def rows(self, now=None):
+        if now == None:
+           now = time.monotonic()
+        with self.lock:
+           return self.buildRows(now)
+
+    def buildRows(self, now):
+        rows = []
+        for t in sorted(self.throttles.values(), key=lambda t: -t.lastSeen):
+            if t.estop:
+               speed = "ESTOP"
+            else:
+               speed = "%d" % t.speed
+            rows.append((chr(t.src) if 0x20 < t.src < 0x7F else "%02X" % t.src,
+                         "%d%s" % (t.address, "s" if t.shortAddr else ""),
+                         speed, "FWD" if t.forward else "REV",
+                         " ".join("F%d" % f for f in t.functionList()),
+                         "-%d dBm" % t.rssi, "%ds" % int(now - t.lastSeen)))
+        return rows
@@ -0,0 +1,124 @@
+
+# Directed requests that are resent until they are answered
+#
+# Every node gets its own retransmit timeout, worked out from the round trip
+# times measured to it the same way TCP does (RFC 6298): a smoothed RTT and
+# RTT variance, RTO = SRTT + 4 * RTTVAR, doubled each time it runs out.  Only
+# requests answered on their first send are timed (Karn's rule), an answer
+# after a resend can't be tied to the send it belongs to.
+#
+# A receiver on the bench settles at a few tens of ms so a lost frame goes
+# again right away, one at the edge of range gets a longer timeout instead of
+# a string of duplicates.
+#
+# reliableRequest is handed send and poll functions rather than a radio:
+# the app's receiver query passes bulkTransfer wrappers on Android,
+# xbeeReliableRequest in txpipeline.py wraps an xbeeController or xbeePool.
+
+import time
+
+RTO_INITIAL      = 1.0         # seconds, before a node has been measured
+RTO_MIN          = 0.03
+RTO_MAX          = 4.0
+RTT_ALPHA        = 1.0 / 8     # gain for SRTT
+RTT_BETA         = 1.0 / 4     # gain for RTTVAR
+RELIABLE_RETRIES = 3           # resends after the first try
+RELIABLE_POLL    = 0.01        # longest wait for a frame before looking at the clock
+
+class rttEstimator:
+    __slots__ = ('srtt', 'rttvar', 'rto', 'minimum', 'maximum', 'samples', 'timeouts', 'lastRtt')
+
+    def __init__(self, initial=RTO_INITIAL, minimum=RTO_MIN, maximum=RTO_MAX):
+        self.srtt     = None
+        self.rttvar   = None
+        self.rto      = initial
+        self.minimum  = minimum
+        self.maximum  = maximum
+        self.samples  = 0
+        self.timeouts = 0
+        self.lastRtt  = None
+
+    def sample(self, rtt):
+        if self.srtt == None:
+           self.srtt = rtt
+           self.rttvar = rtt / 2
+        else:
+           self.rttvar = (1 - RTT_BETA) * self.rttvar + RTT_BETA * abs(self.srtt - rtt)
+           self.srtt = (1 - RTT_ALPHA) * self.srtt + RTT_ALPHA * rtt
+        self.rto = min(self.maximum, max(self.minimum, self.srtt + 4 * self.rttvar))
+        self.samples += 1
+        self.lastRtt = rtt
+
+    def backoff(self):
+        # kept until the next good sample, so the next request starts backed off too
+        self.rto = min(self.maximum, self.rto * 2)
+        self.timeouts += 1
+
+    def summary(self):
+        def ms(v):
+            return None if v == None else round(v * 1000, 1)
+        return {'srtt_ms': ms(self.srtt), 'rttvar_ms': ms(self.rttvar), 'rto_ms': ms(self.rto),
+                'samples': self.samples, 'timeouts': self.timeouts}
+
+class rttTable:
+    def __init__(self, initial=RTO_INITIAL, minimum=RTO_MIN, maximum=RTO_MAX):
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.nodes   = {}              # key (mac or MRBus address) -> rttEstimator
+
+    def get(self, key):
+        est = self.nodes.get(key)
+        if est == None:
+           est = rttEstimator(self.initial, self.minimum, self.maximum)
+           self.nodes[key] = est
+        return est
+
+    def timeout(self, key):
+        return self.get(key).rto
+
+    def sample(self, key, rtt):
+        self.get(key).sample(rtt)
+
+    def backoff(self, key):
+        self.get(key).backoff()
+
+    def summary(self, key):
+        est = self.nodes.get(key)
+        if est == None:
+           return None
+        return est.summary()
+
+##
+## Send until answered.  send() puts the request on the air, poll(timeout)
+## returns a packet or None, match(packet) says what a packet means:
+##    True  - the answer, we're done
+##    False - the request is known lost (e.g. a failed transmit status), resend now
+##    None  - nothing to do with us
+## Returns the answering packet, None if every try ran out
+##
+
+def reliableRequest(send, poll, match, table, key, retries=RELIABLE_RETRIES):
+   for attempt in range(retries + 1):
+      sent = time.monotonic()
+      send()
+      deadline = sent + table.timeout(key)
+
+      while True:
+         now = time.monotonic()
+         if now >= deadline:
+            break
+         p = poll(min(RELIABLE_POLL, deadline - now))
+         if p == None:
+            continue
+         answer = match(p)
+         if answer == True:
+            if attempt == 0:
+               table.sample(key, time.monotonic() - sent)
+            return p
+         if answer == False:
+            break
+
+      table.backoff(key)
+
+   return None
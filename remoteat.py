@@ -0,0 +1,149 @@
+
+# Remote AT commands to the receivers' Xbees, many at a time
+#
+# xbeeRemoteATPipeline sends a list of 0x17 remote AT requests keeping up to
+# 'window' of them in flight, and matches the 0x97 responses back by frame ID.
+# Setting or reading a parameter is the same however often it's done, so a
+# request that times out is sent again under a new frame ID.
+#
+# xbeeRemoteBatch queues settings per MAC and sends them all without applying
+# them, then finishes each radio with a WR (if asked) and a single AC.  One
+# reconfigure per radio instead of one per parameter.
+
+import time
+
+from .xbee import *
+
+REMOTE_TIMEOUT = 2.0           # seconds to wait for each 0x97
+REMOTE_WINDOW  = 16            # requests in flight, must stay under 255 frame IDs
+REMOTE_RETRIES = 2             # resends after the first try
+
+REMOTE_STATUS = { 0: 'OK', 1: 'ERROR', 2: 'invalid command', 3: 'invalid parameter', 4: 'no response' }
+
+def macString(mac):
+   if isinstance(mac, str):
+      return mac.upper()
+   return "".join("{:02X}".format(b) for b in mac)
+
+def macBytes(mac):
+   if isinstance(mac, str):
+      return list(bytes.fromhex(mac))
+   return list(mac)
+
+def remoteStatusName(status):
+   if status == None:
+      return 'timeout'
+   return REMOTE_STATUS.get(status, 'status %d' % status)
+
+##
+## Send requests, a list of (mac, cmd, data, options), pipelined
+## Returns a list of (status, value) in the same order, status None if no
+## answer came after retries resends
+##
+
+def xbeeRemoteATPipeline(xb, requests, window=REMOTE_WINDOW, timeout=REMOTE_TIMEOUT, retries=REMOTE_RETRIES):
+   results = [(None, None)] * len(requests)
+   todo = list(range(len(requests)))
+   tries = [0] * len(requests)
+   pending = {}                   ## frame ID -> (request index, time sent)
+   fid = 0
+
+   while len(todo) > 0 or len(pending) > 0:
+      while len(todo) > 0 and len(pending) < window:
+         fid = fid % 255 + 1      ## 1..255, 0 would turn the response off
+         while fid in pending:
+            fid = fid % 255 + 1
+         i = todo.pop(0)
+         mac, cmd, data, options = requests[i]
+         xb.xbeeTransmitRemoteCommand(macBytes(mac), cmd[0], cmd[1], data, options, fid)
+         pending[fid] = (i, time.monotonic())
+         tries[i] = tries[i] + 1
+
+      p = xb.getPacket()
+      if p != None and len(p) >= 19 and p[3] == 0x97 and p[4] in pending:
+         i = pending[p[4]][0]
+         mac, cmd = requests[i][:2]
+         if macString(p[5:13]) == macString(mac) and bytes(p[15:17]) == cmd.encode():
+            del pending[p[4]]
+            results[i] = (p[17], p[18:-1])
+
+      now = time.monotonic()
+      for f in [f for f in pending if now - pending[f][1] > timeout]:
+         i = pending.pop(f)[0]
+         if tries[i] <= retries:  ## again under a new frame ID, else the result stays None
+            todo.append(i)
+
+   return results
+
+##
+## Batched configuration, queue() settings then send() them
+##
+
+class xbeeRemoteBatch:
+    def __init__(self, xb):
+        self.xb = xb
+        self.settings = {}        # mac string -> list of (cmd, data)
+
+    def queue(self, mac, cmd, data=b''):
+        # one of each command per radio, the report has one status per command
+        settings = self.settings.setdefault(macString(mac), [])
+        if cmd.upper() in [c for c, d in settings]:
+           raise ValueError("AT%s already queued for %s" % (cmd.upper(), macString(mac)))
+        settings.append((cmd.upper(), data))
+
+    def send(self, write=False, window=REMOTE_WINDOW, timeout=REMOTE_TIMEOUT):
+        macs = list(self.settings)
+        report = {}
+        for mac in macs:
+            report[mac] = {'ok': True, 'status': {}}
+
+        # every setting, queued on the remote radio but not applied
+        requests = []
+        for mac in macs:
+            for cmd, data in self.settings[mac]:
+                requests.append((mac, cmd, data, 0x00))
+        self.collect(report, requests, xbeeRemoteATPipeline(self.xb, requests, window, timeout))
+
+        # then write (if asked) and one apply for each radio that took all of
+        # them.  WR has to be answered first, once AC moves a radio to a new
+        # CH or ID we can't reach it to save anything
+        for cmd in (['WR'] if write else []) + ['AC']:
+            requests = []
+            for mac in macs:
+                if report[mac]['ok']:
+                   requests.append((mac, cmd, b'', 0x00))
+            self.collect(report, requests, xbeeRemoteATPipeline(self.xb, requests, window, timeout))
+
+        self.settings = {}
+        return {'ok': all(report[mac]['ok'] for mac in macs), 'nodes': report}
+
+    def collect(self, report, requests, results):
+        for (mac, cmd, data, options), (status, value) in zip(requests, results):
+            report[mac]['status'][cmd] = remoteStatusName(status)
+            if status != 0:
+               report[mac]['ok'] = False
+
+##
+## Diagnostics sweep - firmware, last hop RSSI, power level and channel from
+## every receiver in one pass.  Requests go out command by command across all
+## the MACs so no single receiver gets a burst.  Returns {mac: {cmd: value}},
+## value is None where the receiver didn't answer.  DB is -dBm.
+##
+
+DIAG_COMMANDS = ['VR', 'DB', 'PL', 'CH']
+DIAG_WINDOW   = 32
+
+def xbeeDiagnosticsSweep(xb, macs, commands=DIAG_COMMANDS, window=DIAG_WINDOW, timeout=REMOTE_TIMEOUT):
+   requests = []
+   for cmd in commands:
+      for mac in macs:
+         requests.append((mac, cmd, b'', 0x00))
+
+   table = {}
+   for mac in macs:
+      table[macString(mac)] = dict.fromkeys(commands)
+
+   for (mac, cmd, data, options), (status, value) in zip(requests, xbeeRemoteATPipeline(xb, requests, window, timeout)):
+      if status == 0:
+         table[macString(mac)][cmd] = int.from_bytes(bytes(value), 'big')
+   return table
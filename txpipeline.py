@@ -0,0 +1,30 @@
+
+# Directed (64 bit address) transmits that want an answer
+#
+# xbeeReliableRequest is for one request that wants an answer from the
+# receiver itself, resent on that receiver's adaptive timeout (reliable.py).
+# Windowed EEPROM writes to many receivers are in eeprom.py (eepromWriteMany).
+
+from .xbee import *
+from .remoteat import macBytes, macString
+from .reliable import reliableRequest, RELIABLE_RETRIES
+
+##
+## Send data to mac until answer(packet) is True, returns the packet or None
+## A failed 0x89 for our frame means the Xbee already gave up, resend now
+##
+
+def xbeeReliableRequest(xb, mac, data, answer, table, retries=RELIABLE_RETRIES, fid=0x01):
+   dest = macBytes(mac)
+
+   def send():
+      xb.xbeeTransmitDataFrame(dest, data, fid)
+
+   def match(p):
+      if len(p) >= 7 and p[3] == 0x89 and p[4] == fid and p[5] != 0:
+         return False
+      if answer(p):
+         return True
+      return None
+
+   return reliableRequest(send, xb.getPacket, match, table, macString(mac), retries)
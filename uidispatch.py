@@ -0,0 +1,71 @@
+
+# Batched UI updates
+#
+# Radio code doesn't touch widgets.  It asks the dispatcher for an update,
+# keyed by what it changes (a widget attribute, or any key for a refresh
+# function), and the dispatcher applies everything asked for since the last
+# batch on the app's event loop, at most once every UI_INTERVAL.  A later
+# request for the same key replaces an earlier one still waiting, so a label
+# updated by a hundred frames is redrawn once.  UI work follows the screen
+# refresh rate instead of the packet rate.
+#
+# Requests may come from any thread (the reader threads and executors used
+# for the radio), widgets are only touched on the loop.
+
+import time
+import threading
+import traceback
+
+UI_INTERVAL = 0.03             # seconds, about one batch per screen refresh or two
+
+class uiDispatcher:
+    def __init__(self, loop, interval=UI_INTERVAL):
+        self.loop      = loop
+        self.interval  = interval
+        self.pending   = {}            # key -> (function, args), latest wins
+        self.lock      = threading.Lock()
+        self.armed     = False         # a flush is scheduled
+        self.lastFlush = 0.0
+        self.requested = 0
+        self.applied   = 0
+        self.flushes   = 0
+
+    # widget.attr = value on the next batch
+    def set(self, widget, attr, value):
+        self.call((id(widget), attr), setattr, widget, attr, value)
+
+    # function(*args) on the next batch, replacing anything waiting under key
+    def call(self, key, function, *args):
+        with self.lock:
+            self.pending[key] = (function, args)
+            self.requested += 1
+            if self.armed:
+               return
+            self.armed = True
+        self.loop.call_soon_threadsafe(self.arm)
+
+    def arm(self):
+        wait = self.lastFlush + self.interval - time.monotonic()
+        if wait > 0:
+           self.loop.call_later(wait, self.flush)
+        else:
+           self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+            self.armed = False
+        self.lastFlush = time.monotonic()
+        self.flushes += 1
+        for function, args in pending.values():
+            try:
+               function(*args)
+            except Exception:
+               # one bad update mustn't stop the rest of the batch, but say which and why
+               print ("UI update failed in", getattr(function, '__qualname__', function), args)
+               traceback.print_exc()
+            self.applied += 1
+
+    def summary(self):
+        return {'requested': self.requested, 'applied': self.applied, 'flushes': self.flushes}
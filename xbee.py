@@ -1,42 +1,194 @@
 
 # PTConfigure Version of Xbee communications  for windows
 
+import os
+import json
+import time
+import concurrent.futures
 import serial
 import serial.tools.list_ports
 
-## MRBUS Protothrottle utility routines
-
-def mrbusCRC16Calculate(data):
-   mrbusPktLen = data[2]
-   crc = 0
-   for i in range(0, mrbusPktLen):
-      if i == 3 or i == 4:
-         continue
-      else:
-         a = data[i]
-      crc = mrbusCRC16Update(crc, a)
-   return crc
-
-def mrbusCRC16Update(crc, a):
-   MRBus_CRC16_HighTable = [ 0x00, 0xA0, 0xE0, 0x40, 0x60, 0xC0, 0x80, 0x20, 0xC0, 0x60, 0x20, 0x80, 0xA0, 0x00, 0x40, 0xE0 ]
-   MRBus_CRC16_LowTable =  [ 0x00, 0x01, 0x03, 0x02, 0x07, 0x06, 0x04, 0x05, 0x0E, 0x0F, 0x0D, 0x0C, 0x09, 0x08, 0x0A, 0x0B ]
-   crc16_h = (crc>>8) & 0xFF
-   crc16_l = crc & 0xFF
-   i = 0
-   while i < 2:
-      if i != 0:
-         w = ((crc16_h << 4) & 0xF0) | ((crc16_h >> 4) & 0x0F)
-         t = (w ^ a) & 0x0F
-      else:
-         t = (crc16_h ^ a) & 0xF0
-         t = ((t << 4) & 0xF0) | ((t >> 4) & 0x0F)
-      crc16_h = (crc16_h << 4) & 0xFF
-      crc16_h = crc16_h | (crc16_l >> 4)
-      crc16_l = (crc16_l << 4) & 0xFF
-      crc16_h = crc16_h ^ MRBus_CRC16_HighTable[t]
-      crc16_l = crc16_l ^ MRBus_CRC16_LowTable[t]
-      i = i + 1
-   return (crc16_h<<8) | crc16_l
+from .frames import *
+
+##
+## Xbee port detection
+##
+## Only trust a port once the Xbee on it has answered an API mode ATVR.
+## The last good port is cached on disk, it (or the same CP210x by VID:PID
+## and serial number under a new name) is tried first.  If that fails every
+## other CP210x is probed at the same time, one thread per port.
+##
+
+XBEE_BAUDRATE  = 38400
+CP210X_VID     = 0x10C4
+CP210X_PID     = 0xEA60
+PROBE_TIMEOUT  = 0.6
+PACKET_POLL    = 0.002         # seconds between looks at the port while getPacket waits for a frame
+PORTCACHE      = os.path.join(os.path.expanduser('~'), '.ptreceiver', 'xbeeport.json')
+XBEE_FAST_BAUDRATES = (115200,)
+
+def xbeeATFrame(cmd, fid=1, data=b''):
+   body = [0x08, fid, ord(cmd[0]), ord(cmd[1])] + list(data)
+   cks = (0xFF - (sum(body) & 0xFF)) & 0xFF
+   return bytes([0x7e, 0, len(body)] + body + [cks])
+
+## local AT command straight on the port, returns (status, value) of the
+## answer, (None, None) if there wasn't one
+
+def xbeeATQuery(sp, cmd='VR', data=b'', timeout=PROBE_TIMEOUT):
+   sp.reset_input_buffer()
+   sp.write(xbeeEscapeFrame(xbeeATFrame(cmd, 0x52, data)))
+   rx = b''
+   deadline = time.monotonic() + timeout
+   while time.monotonic() < deadline:
+      rx = rx + sp.read(max(1, sp.in_waiting))
+      data = xbeeUnescape(rx)
+      i = data.find(b'\x7e')            ## 7E len len 88 52 'V' 'R' status value ... cks
+      while i >= 0 and len(data) >= i + 8:
+         end = i + 4 + ((data[i+1] << 8) | data[i+2])
+         if data[i+3] == 0x88 and data[i+4] == 0x52 and data[i+5:i+7] == cmd.encode() and len(data) >= end:
+            return data[i+7], data[i+8:end-1]
+         i = data.find(b'\x7e', i + 1)
+   return None, None
+
+def xbeeATHandshake(sp, cmd='VR', data=b'', timeout=PROBE_TIMEOUT):
+   return xbeeATQuery(sp, cmd, data, timeout)[0] == 0
+
+def xbeeProbePort(name):
+   try:
+      sp = serial.Serial(name, XBEE_BAUDRATE, timeout=0.05)
+   except Exception:
+      return None
+   try:
+      for baud in (XBEE_BAUDRATE,) + XBEE_FAST_BAUDRATES:   ## may still be fast from a session that died
+         sp.baudrate = baud
+         if xbeeATHandshake(sp):
+            sp.timeout = 0.25
+            return sp
+   except Exception:
+      pass
+   sp.close()
+   return None
+
+def xbeeLoadPortCache():
+   try:
+      with open(PORTCACHE) as f:
+         return json.load(f)
+   except Exception:
+      return {}
+
+def xbeePortEntry(port):
+   return {'port': port.device, 'vid': port.vid, 'pid': port.pid, 'serial_number': port.serial_number}
+
+def xbeePortMatches(p, entry):
+   # same name, or the same CP210x by VID:PID and serial number under a new name
+   if p.device == entry.get('port'):
+      return True
+   return p.serial_number != None and p.serial_number == entry.get('serial_number') \
+          and (p.vid, p.pid) == (entry.get('vid'), entry.get('pid'))
+
+def xbeeSavePortCache(port, **lists):
+   cache = xbeeLoadPortCache()
+   if port != None:
+      cache.update(xbeePortEntry(port))
+   cache.update(lists)                    ## 'ports' and 'others' from xbeeDetectAllPorts
+   try:
+      os.makedirs(os.path.dirname(PORTCACHE), exist_ok=True)
+      with open(PORTCACHE, 'w') as f:
+         json.dump(cache, f)
+   except Exception as e:
+      print ('unable to save port cache', e)
+
+def xbeeCandidatePorts():
+   ports = sorted(serial.tools.list_ports.comports(), key=lambda p: p.device)
+   return [p for p in ports if (p.vid, p.pid) == (CP210X_VID, CP210X_PID) or 'CP210' in (p.description or '')]
+
+def xbeeDetectPort():
+   cache = xbeeLoadPortCache()
+   candidates = xbeeCandidatePorts()
+
+   def known(p):
+      return xbeePortMatches(p, cache)
+
+   for p in [p for p in candidates if known(p)]:     ## fast path, the one that worked last time
+      sp = xbeeProbePort(p.device)
+      if sp != None:
+         print ('xbee port opened', p.device, '(cached)')
+         if p.device != cache.get('port'):
+            xbeeSavePortCache(p)
+         return sp
+
+   rest = [p for p in candidates if not known(p)]
+   if len(rest) == 0:
+      print ('Silicon Labs CP210x Xbee Not Found!')
+      return None
+
+   found = None
+   with concurrent.futures.ThreadPoolExecutor(max_workers=len(rest)) as pool:
+      probes = {pool.submit(xbeeProbePort, p.device): p for p in rest}
+      for f in concurrent.futures.as_completed(probes):
+         sp = f.result()
+         if sp == None:
+            continue
+         if found == None:
+            found = (probes[f], sp)
+         else:
+            sp.close()                           ## two Xbees, keep the first to answer
+
+   if found == None:
+      print ('Silicon Labs CP210x Xbee Not Found!')
+      return None
+
+   port, sp = found
+   print ('xbee port opened', port.device)
+   xbeeSavePortCache(port)
+   return sp
+
+##
+## Every Xbee, for xbeePool.  The cache remembers which CP210x ports had an
+## Xbee ('ports') and which didn't answer ('others').  Cached Xbees and ports
+## never seen before are probed, the ones that didn't answer last time are
+## skipped unless nothing else turns up an Xbee.
+##
+
+def xbeeProbePorts(ports):
+   found = []
+   if len(ports) == 0:
+      return found
+   with concurrent.futures.ThreadPoolExecutor(max_workers=len(ports)) as pool:
+      probes = [(p, pool.submit(xbeeProbePort, p.device)) for p in ports]
+      for p, f in probes:
+         sp = f.result()
+         if sp != None:
+            found.append((p, sp))
+   return found
+
+def xbeeDetectAllPorts():
+   cache = xbeeLoadPortCache()
+   candidates = xbeeCandidatePorts()
+   if len(candidates) == 0:
+      print ('Silicon Labs CP210x Xbee Not Found!')
+      return []
+
+   def skipped(p):
+      return any(xbeePortMatches(p, e) for e in cache.get('others', [])) \
+             and not any(xbeePortMatches(p, e) for e in cache.get('ports', []))
+
+   first = [p for p in candidates if not skipped(p)]
+   rest  = [p for p in candidates if skipped(p)]
+
+   found = xbeeProbePorts(first)
+   if len(found) == 0:
+      found = xbeeProbePorts(rest)
+
+   xbees = [p for p, sp in found]
+   xbeeSavePortCache(xbees[0] if len(xbees) > 0 else None,
+                     ports=[xbeePortEntry(p) for p in xbees],
+                     others=[xbeePortEntry(p) for p in candidates if p not in xbees])
+
+   for p in xbees:
+      print ('xbee port opened', p.device)
+   return [(p.device, sp) for p, sp in found]
 
 ##
 ## Main Xbee Class.  Everything lives here
@@ -50,27 +202,33 @@ def mrbusCRC16Update(crc, a):
 ##
 
 class xbeeController:
-    def __init__(self):
-        # start on COM1, open each until we find the Xbee
-        self.sp = None
-
-        ports = serial.tools.list_ports.comports()
-
-        for port, desc, hwid in sorted(ports):
-            if 'Silicon Labs CP210' in desc:
-               try:
-                  sp = serial.Serial(port, 38400, timeout=0.25)
-                  self.sp = sp
-                  print ('xbee port opened')
-                  return
-               except:
-                  print ('Silicon Labs CP210x USB Driver Not Found!')
-                  pass
+    def __init__(self, port=None, sp=None):
+        # use the port we're told, otherwise go find a port with an Xbee on it
+        self.sp = sp
+
+        if sp != None:
+           return
+
+        if port != None:
+           try:
+              self.sp = serial.Serial(port, XBEE_BAUDRATE, timeout=0.25)
+              print ('xbee port opened', port)
+           except Exception as e:
+              print ('unable to open', port, e)
+           return
+
+        self.sp = xbeeDetectPort()
 
     def getStatus(self):
         return self.sp
 
+    # how many ND terminators a discovery ends with, see xbeePool
+    def discoveryRadios(self):
+        return 1
+
     def close(self):
+        if self.sp.baudrate != XBEE_BAUDRATE:   ## leave the Xbee the way we found it
+           self.xbeeNegotiateBaud(XBEE_BAUDRATE)
         self.sp.close()
 
     def clear(self):
@@ -80,12 +238,52 @@ class xbeeController:
     def xbeeReturnResult(self, datalength):
         return(self.sp.read(datalength))
 
+##
+## Change the host <-> Xbee baud rate with ATBD
+## The new rate is not written (no ATWR), a power cycle puts the Xbee back
+## at 38400.  Returns the rate actually in use, the old one if anything failed
+##
+
+    def xbeeNegotiateBaud(self, baud):
+        old = self.sp.baudrate
+        if baud == old:
+           return old
+
+        if not xbeeATHandshake(self.sp, 'BD', xbeeBDParam(baud)):
+           print ('Xbee refused baud rate', baud)
+           return old
+
+        self.sp.baudrate = baud          ## Xbee switches after it answers
+        time.sleep(0.05)
+        if xbeeATHandshake(self.sp):
+           print ('xbee now at', baud)
+           return baud
+
+        print ('no answer at', baud, 'falling back to', old)
+        self.sp.baudrate = old
+        if xbeeATHandshake(self.sp):
+           return old
+
+        self.sp.baudrate = baud          ## it did switch but the link is bad, ask it to go back
+        xbeeATHandshake(self.sp, 'BD', xbeeBDParam(old))
+        self.sp.baudrate = old
+        time.sleep(0.05)
+        if not xbeeATHandshake(self.sp):
+           print ('lost the xbee changing baud rate')
+        return old
+
 ##
 ## Get Packet - main read of Xbee message coming in from the outside world
 ## Returns a list containing the actual API message bytea
 ##
 
-    def getPacket(self):
+    def getPacket(self, timeout=None):
+        if timeout != None:      ## wait at most this long for a frame to start, the port
+           deadline = time.monotonic() + timeout    ## timeout is left alone, once a frame
+           while self.sp.in_waiting == 0:           ## has started the rest of it is read
+              if time.monotonic() >= deadline:      ## with that like any other
+                 return None
+              time.sleep(PACKET_POLL)
         r = self.sp.read(1)      ## look for waiting byte in the buffer
         if r == '':
            return None           ## Nothing there, return None
@@ -111,26 +309,19 @@ class xbeeController:
                 print ("FOUND START")
                 break            ## Means we lost one somewhere
 
-        l1 = self.sp.read(1)     ## length byte SHOULD be the beginning
-        if l1 == '':
-           print ("ERROR - Low")
+        length = self.readUnescaped(2)   ## length bytes SHOULD be the beginning
+        if len(length) < 2:
+           print ("ERROR - Length")
            return None           ## Bad if not
 
-        lh = ord(l1)             ## Get low byte of length
-
-        l2 = self.sp.read(1)     ## This should be high byte of length
-        if l2 == '':
-           print ("ERROR - High")
-           return None ## Bad if not there
-        ll = ord(l2)
-
-        l = lh << 8
-        l = lh | ll
+        lh = length[0]           ## high byte of length
+        ll = length[1]           ## low byte of length
+        l = (lh << 8) | ll
 
         ## Valid (we hope) length computed, read the rest all at once
 
         try:
-           data = self.sp.read(l+1)
+           data = self.readUnescaped(l+1)
         except:
            return None
 
@@ -146,6 +337,36 @@ class xbeeController:
 
         return r
 
+##
+## Read n bytes of a frame, undoing the API mode 2 escapes
+##
+
+    def readUnescaped(self, n):
+        raw = self.sp.read(n)
+        while len(raw) - raw.count(0x7D) < n or raw.endswith(b'\x7d'):
+           more = self.sp.read(max(1, n - (len(raw) - raw.count(0x7D))))
+           if len(more) == 0:
+              break
+           raw = raw + more
+        return xbeeUnescape(raw)
+
+##
+## Collect Packets - read everything the Xbee sends for up to 'seconds'
+## Stops early when until(packet) returns True, returns list of packets
+##
+
+    def xbeeCollectPackets(self, seconds, until=None):
+        packets = []
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            p = self.getPacket()
+            if p == None:
+               continue
+            packets.append(p)
+            if until != None and until(p):
+               break
+        return packets
+
 ##
 ## Send BroadcastRequest to Xbee for r/w data to/from Protothrottle
 ## Max length is 12 for all transactions, read and write
@@ -155,32 +376,20 @@ class xbeeController:
 ##  'W', LSB, MSB, DATA, DATA, DATA etc - write data to Protothrottle
 ##
 
-    def xbeeBroadCastRequest(self, dest, src, data):
+    def xbeeBroadCastRequest(self, dest, src, data, fid=0x00):
         pktLen = 10 + len(data) # MRBus overhead, 5 XBee, and the data
         frame = []
         frame.append(0x7e)	         # 0 - Start
         frame.append(0)              # 1 - Len MSB
         frame.append(pktLen)         # 2 - Len LSB
         frame.append(0x01)           # 3 - COMMAND - transmit 16 bit address
-        frame.append(0x00)	         # 4 - frame ID for ack- 0 = disable
+        frame.append(fid)	         # 4 - frame ID for ack- 0 = disable
         frame.append(0xFF)           # 5 - MSB of dest address - broadcast 0xFFFF
         frame.append(0xFF)	         # 6 - LSB of dest address
         frame.append(0)	             # 7 - Transmit Options
 
-        # mrbus stuff
-        frame.append(dest)           # 8 / 0 - Destination
-        frame.append(src)            # 9 / 1 - Source
-        frame.append(len(data) + 5)  # 10/ 2 - Length
-        frame.append(0)              # 11/ 3 - CRC High
-        frame.append(0)              # 12/ 4 - CRC Low
-
-        for b in data:
-           frame.append(int(b) & 0xFF)
-
-        # this is specific to the mrbus implementation in the PT
-        crc = mrbusCRC16Calculate(frame[8:])
-        frame[11] = 0xFF & crc
-        frame[12] = 0xFF & (crc >> 8)
+        # mrbus stuff, 8 on
+        frame.extend(mrbusPacket(dest, src, data))
 
         xbeeChecksum = 0
         for i in range(3, len(frame)):
@@ -188,18 +397,7 @@ class xbeeController:
         xbeeChecksum = (0xFF - xbeeChecksum) & 0xFF;
         frame.append(xbeeChecksum)
 
-        txBufferEscaped = [ frame[0] ]
-
-        escapedChars = frozenset([0x7E, 0x7D, 0x11, 0x13])
-
-        for i in range(1, len(frame)):
-           if frame[i] in escapedChars:
-              txBufferEscaped.append(0x7D)
-              txBufferEscaped.append(frame[i] ^ 0x20)
-           else:
-              txBufferEscaped.append(frame[i])
-
-        self.sp.write(txBufferEscaped)
+        self.sp.write(xbeeEscapeFrame(frame))
 
 
 ##
@@ -236,7 +434,7 @@ class xbeeController:
 ## Send Directed Message to an Xbee on the Network
 ##
 
-    def xbeeTransmitDataFrame(self, dest, data):
+    def xbeeTransmitDataFrame(self, dest, data, fid=0x01):
         txdata = []
         dl = len(data)
         for d in data:     # make sure it's in valid bytes for transmit
@@ -250,7 +448,7 @@ class xbeeController:
         frame.append(0)	        # our data is always < 256
         frame.append(dl+11)     # all data except header, length and checksum
         frame.append(0x00)      # TRANSMIT REQUEST 64bit (mac) address - send Query to Xbee module
-        frame.append(0x01)      # frame ID for ack- 0 = disable
+        frame.append(fid)       # frame ID for ack- 0 = disable
 
         frame.append(dest[0])   # 64 bit address (mac)
         frame.append(dest[1])
@@ -274,9 +472,7 @@ class xbeeController:
         i = (255-cks) & 0x00ff
         frame[dl+14] = i        # insert checksum in message
 
-        for d in frame:        # transmit message out to Xbee via USB
-            t = bytes([d])
-            self.sp.write( t )
+        self.sp.write(xbeeEscapeFrame(frame))   # transmit message out to Xbee via USB, escaped for AP=2
 
         p = "Tx : "            # print what we sent in hex
         for d in frame:
@@ -286,11 +482,20 @@ class xbeeController:
 
 ##############################################################################
 
-    def xbeeTransmitRemoteCommand(self, dest, cmda, cmdb, data):
+## options 0x02 applies the change right away, 0x00 queues it for an AC
+## data is a string as before, or bytes / list of ints for binary parameters
+
+    def xbeeTransmitRemoteCommand(self, dest, cmda, cmdb, data, options=0x02, fid=0x01):
         txdata = []
-        data = data[:20].strip()
+        if isinstance(data, str):
+           data = data[:20].strip()
+        else:
+           data = data[:20]
         for d in data:     # make sure it's in valid bytes for transmit
-            txdata.append(int(ord(d)))
+            try:
+               txdata.append(int(ord(d)))
+            except:
+               txdata.append(int(d))
 
         cmda = ord(cmda)
         cmdb = ord(cmdb)
@@ -304,7 +509,7 @@ class xbeeController:
 
         frame.append(length)    # this is all data except header, length and checksum
         frame.append(0x17)      # REMOTE AT COMMAND
-        frame.append(0x01)      # frame ID for ack- 0 = disable
+        frame.append(fid)       # frame ID for ack- 0 = disable
 
         frame.append(dest[0])   # 64 bit address (mac)
         frame.append(dest[1])
@@ -318,7 +523,7 @@ class xbeeController:
         frame.append(0xff)      # always reserved
         frame.append(0xfe)
 
-        frame.append(0x02)      # always apply changes immediate
+        frame.append(options)   # 0x02 apply changes immediate
 
         frame.append(cmda)      # remote command
         frame.append(cmdb)
@@ -333,9 +538,7 @@ class xbeeController:
 
         i = (255-cks) & 0x00ff
         frame[length+3] = i
-        for d in frame:
-            t = bytes([d])
-            self.sp.write( t )
+        self.sp.write(xbeeEscapeFrame(frame))   # one write, these get sent back to back
 
 #        for d in frame:
 #            p = "%2x - %s" % (d, chr(d))
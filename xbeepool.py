@@ -0,0 +1,178 @@
+
+# Several Xbee dongles used as one
+#
+# Every detected Xbee gets its own xbeeController and its own reader thread.
+# Packets from all of them land in one queue tagged with the radio (port
+# name) they came in on.  Every packet also goes through a node registry so
+# 16 bit sources (0x81 frames, most receiver traffic) resolve to a MAC, and
+# directed traffic goes out the radio that last heard the destination MAC.  Broadcasts and ND go out once per network (PAN ID and
+# channel), on the first radio of each, so two dongles on the same PAN don't
+# put every packet on the air twice.  Other local AT commands go to every radio.
+#
+# The pool has the same calls as xbeeController, so anything written for a
+# single radio (the app, the command line tool) can be handed a pool instead.
+
+import time
+import queue
+import threading
+
+from .xbee import *
+from .nodes import nodeRegistry
+
+class xbeePool:
+    def __init__(self, controllers=None, nodes=None):
+        # controllers is a dict of name: xbeeController, default is every Xbee we can find
+        # nodes is the nodeRegistry to keep up to date, the app passes its own
+        if controllers == None:
+           controllers = {}
+           for name, sp in xbeeDetectAllPorts():
+               controllers[name] = xbeeController(sp=sp)
+
+        self.radios    = controllers
+        self.names     = sorted(controllers)
+        self.locks     = {}                  # one writer at a time per radio
+        self.readLocks = {}                  # held by the reader thread while it reads
+        self.paused    = set()               # radios whose reader is held off
+        self.heardMac  = {}                  # mac string -> radio that last heard it
+        self.nodes     = nodeRegistry() if nodes == None else nodes
+        self.events    = queue.Queue()
+        self.lastRadio = None
+        self.running   = True
+        self.threads   = []
+
+        # one radio per network for broadcasts, asked before the readers start
+        self.networks  = {}                  # (ID, CH) -> radio names on it
+        for name in self.names:
+            self.networks.setdefault(self.radioNetwork(name), []).append(name)
+        self.airNames  = [self.networks[n][0] for n in self.networks]
+
+        for name in self.names:
+            self.locks[name] = threading.Lock()
+            self.readLocks[name] = threading.Lock()
+            t = threading.Thread(target=self.reader, args=(name,), daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def reader(self, name):
+        xb = self.radios[name]
+        while self.running:
+            if name in self.paused:
+               time.sleep(0.05)
+               continue
+            try:
+               with self.readLocks[name]:
+                  p = xb.getPacket()
+            except Exception as e:
+               print ('radio', name, 'read failed', e)
+               time.sleep(0.5)
+               continue
+            if p == None or len(p) < 4:
+               continue
+            node = self.nodes.update(p)      # 0x81 frames resolve through the 16 bit address
+            if node != None:
+               self.heardMac[node.mac] = name
+            self.events.put((name, p))
+
+    def radioNetwork(self, name):
+        sp = self.radios[name].sp
+        idStatus, pan = xbeeATQuery(sp, 'ID')
+        chStatus, channel = xbeeATQuery(sp, 'CH')
+        if idStatus != 0 or chStatus != 0:
+           return name                       # can't tell, treat it as its own network
+        return (bytes(pan).hex(), bytes(channel).hex())
+
+    def getStatus(self):
+        return len(self.radios) > 0 or None
+
+    # how many ND terminators a discovery ends with
+    def discoveryRadios(self):
+        return len(self.airNames)
+
+    def close(self):
+        self.running = False
+        for t in self.threads:
+            t.join(1.0)
+        for name in self.names:
+            self.radios[name].close()
+
+    def clear(self):
+        for name in self.names:
+            self.radios[name].clear()
+        while not self.events.empty():
+            self.events.get_nowait()
+
+##
+## Reading - one merged stream, getEvent returns (radio, packet)
+## getPacket is the drop in for xbeeController.getPacket
+##
+
+    def getEvent(self, timeout=0.25):
+        try:
+           return self.events.get(timeout=timeout)
+        except queue.Empty:
+           return None, None
+
+    def getPacket(self, timeout=None):
+        name, p = self.getEvent(0.25 if timeout == None else timeout)
+        if p != None:
+           self.lastRadio = name
+        return p
+
+    def xbeeCollectPackets(self, seconds, until=None):
+        packets = []
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            name, p = self.getEvent(min(0.25, max(0.0, deadline - time.monotonic())))
+            if p == None:
+               continue
+            packets.append(p)
+            if until != None and until(p):
+               break
+        return packets
+
+##
+## Writing - directed traffic goes to the radio that last heard the MAC
+##
+
+    def radioFor(self, dest):
+        mac = "".join("{:02X}".format(b) for b in dest[:8])
+        return self.heardMac.get(mac, self.names[0])
+
+    def send(self, name, call, *args):
+        with self.locks[name]:
+           return getattr(self.radios[name], call)(*args)
+
+    def sendAll(self, call, *args):
+        for name in self.names:
+            self.send(name, call, *args)
+
+    def sendAir(self, call, *args):
+        for name in self.airNames:
+            self.send(name, call, *args)
+
+    def xbeeTransmitDataFrame(self, dest, data, fid=0x01):
+        self.send(self.radioFor(dest), 'xbeeTransmitDataFrame', dest, data, fid)
+
+    def xbeeTransmitRemoteCommand(self, dest, cmda, cmdb, data, options=0x02, fid=0x01):
+        self.send(self.radioFor(dest), 'xbeeTransmitRemoteCommand', dest, cmda, cmdb, data, options, fid)
+
+    def xbeeBroadCastRequest(self, dest, src, data, fid=0x00):
+        self.sendAir('xbeeBroadCastRequest', dest, src, data, fid)
+
+    def xbeeDataQuery(self, cmdh, cmdl):
+        if cmdh + cmdl == 'ND':
+           self.sendAir('xbeeDataQuery', cmdh, cmdl)
+        else:
+           self.sendAll('xbeeDataQuery', cmdh, cmdl)
+
+    def xbeeNegotiateBaud(self, baud):
+        # the handshake reads its own answers, hold each reader off while it runs
+        rates = []
+        for name in self.names:
+            self.paused.add(name)
+            try:
+               with self.readLocks[name]:
+                  rates.append(self.send(name, 'xbeeNegotiateBaud', baud))
+            finally:
+               self.paused.discard(name)
+        return min(rates)               # slowest radio sets the rate we report